@@ -0,0 +1,165 @@
+import io
+import os
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+from collections import defaultdict
+
+import mock_shopify
+import mock_mypos
+from cache import TTLCache
+from orders import process_order
+from http_session import PooledSession
+from rate_limiter import ShopifyRateLimiter
+from shopify_client import ShopifyStoreClient, MYPOSConnectClient
+
+# Measures loads, syncs and order processing against mock_shopify.py and mock_mypos.py:
+#   python benchmark.py --products 2000 --variants 3 --latency 0.05 --leak-rate 20
+# Every scenario reports throughput, upstream calls per variant (or order line) and p50/p99 call latency.
+
+SCENARIOS = ('load', 'load_bulk', 'sync', 'sync_snapshot', 'sync_repeat', 'orders')
+
+
+class CallRecorder():
+    # Latency of every upstream call, collected through a requests response hook on the clients' sessions
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+
+    def session(self, upstream: str) -> PooledSession:
+        session = PooledSession()
+        session.hooks['response'].append(lambda response, *args, **kwargs: self.record(upstream, response))
+        return session
+
+    def record(self, upstream: str, response):
+        with self.lock:
+            self.latencies[upstream].append(response.elapsed.total_seconds())
+
+    def take(self) -> dict:
+        with self.lock:
+            latencies, self.latencies = self.latencies, defaultdict(list)
+        return latencies
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100.0 * len(values)) - 1)]
+
+
+def run_scenario(name: str, func, units: dict, recorder: CallRecorder, verbose: bool = False) -> dict:
+    # units maps what the scenario works through (products, variants, orders, ...) to how many
+    recorder.take()
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with output:
+        func()
+    seconds = time.perf_counter() - started
+    latencies = recorder.take()
+    calls = {upstream: len(values) for upstream, values in latencies.items()}
+    per_unit = units.get('variants') or units.get('line_items') or 1
+    return {'scenario': name, 'seconds': round(seconds, 3),
+            'per_sec': {unit: round(count / seconds, 1) for unit, count in units.items()},
+            'calls': calls, 'calls_per_variant': round(sum(calls.values()) / per_unit, 3),
+            'latency_ms': {upstream: {'p50': round(percentile(values, 50) * 1000, 1), 'p99': round(percentile(values, 99) * 1000, 1)}
+                           for upstream, values in latencies.items()}}
+
+
+def make_order(number: int, codes: list, line_items: int) -> dict:
+    return {'order_number': number, 'created_at': '2021-01-01T10:00:00-05:00', 'tax_lines': [],
+            'customer': {'first_name': 'Bench', 'last_name': f"Mark {number}"},
+            'line_items': [{'sku': random.choice(codes), 'price': '9.99', 'quantity': 1, 'taxable': True, 'tax_lines': []}
+                           for _ in range(line_items)]}
+
+
+def run(args) -> list:
+    random.seed(args.seed)
+    shop = mock_shopify.MockShop(args.products, args.variants, latency=args.latency, bulk_delay=args.bulk_delay,
+                                 bucket_size=args.bucket_size, leak_rate=args.leak_rate)
+    mypos = mock_mypos.MockMYPOS(args.products, args.variants, latency=args.mypos_latency)
+    servers = [mock_shopify.run_server(shop), mock_mypos.run_server(mypos)]
+    data_dir = tempfile.mkdtemp(prefix='sync-benchmark-')
+    recorder = CallRecorder()
+    try:
+        shop_name = f"benchmark-{int(time.time() * 1000)}.myshopify.com"
+        # The client's bucket has to leak as fast as the mock's, not at the standard plan's 2/s
+        limiter = ShopifyRateLimiter.for_shop(shop_name)
+        limiter.capacity, limiter.leak_rate = args.bucket_size, args.leak_rate
+        shopify_client = ShopifyStoreClient(shop=shop_name, access_token='benchmark', session=recorder.session('shopify'),
+                                            api_url=shop.api_url, data_dir=data_dir)
+        os.makedirs(f"{data_dir}/settings", exist_ok=True)
+        mypos_session = recorder.session('mypos')
+        token = mypos_session.post(f"{mypos.api_url}auth/token").json()['bearerToken']
+        mypos_client = MYPOSConnectClient(access_token=token, session=mypos_session, api_url=mypos.api_url,
+                                          product_cache=TTLCache(args.products * args.variants, 3600))
+
+        catalog = {'products': args.products, 'variants': args.products * args.variants}
+        orders = [make_order(number, mypos.codes, args.order_lines) for number in range(args.orders)]
+
+        def reset_levels():
+            shop.levels = dict.fromkeys(shop.levels, 0)
+
+        scenarios = {
+            'load': lambda: shopify_client.load_all_products(),
+            'load_bulk': lambda: shopify_client.load_all_products_bulk(),
+            'sync': lambda: (reset_levels(), shopify_client.sync_products(mypos_client, concurrent=True)),
+            # What the sync job runs: MYPOS catalog snapshot and writes skipped when the last pushed level still holds
+            'sync_snapshot': lambda: (reset_levels(), shopify_client.store.clear_pushed_levels(),
+                                      shopify_client.sync_products(mypos_client, concurrent=True, snapshot=True, diff_only=True)),
+            'sync_repeat': lambda: shopify_client.sync_products(mypos_client, concurrent=True, snapshot=True, diff_only=True),
+            'orders': lambda: [process_order(order, mypos_client) for order in orders],
+        }
+        units = {name: catalog for name in scenarios}
+        units['orders'] = {'orders': args.orders, 'line_items': args.orders * args.order_lines}
+        if 'sync' in args.scenarios or 'sync_snapshot' in args.scenarios or 'sync_repeat' in args.scenarios:
+            if 'load' not in args.scenarios and 'load_bulk' not in args.scenarios:
+                shopify_client.load_all_products_bulk()
+
+        results = []
+        for name in args.scenarios:
+            results.append(run_scenario(name, scenarios[name], units[name], recorder, verbose=args.verbose))
+        return results
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def print_results(results: list):
+    print(f"{'scenario':<14}{'seconds':>9}  {'throughput':<40}{'calls/var':>10}  latency p50/p99 ms")
+    for result in results:
+        throughput = ', '.join(f"{rate} {unit}/s" for unit, rate in result['per_sec'].items())
+        latency = ', '.join(f"{upstream} {values['p50']}/{values['p99']}" for upstream, values in result['latency_ms'].items())
+        print(f"{result['scenario']:<14}{result['seconds']:>9}  {throughput:<40}{result['calls_per_variant']:>10}  {latency}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark loads, syncs and order processing against mock upstreams')
+    parser.add_argument('--products', type=int, default=500)
+    parser.add_argument('--variants', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every Shopify call')
+    parser.add_argument('--mypos-latency', type=float, default=0.02, help='seconds added to every MYPOS call')
+    parser.add_argument('--bucket-size', type=int, default=mock_shopify.MOCK_BUCKET_SIZE)
+    parser.add_argument('--leak-rate', type=float, default=20.0, help='Shopify calls per second (2 standard, 20 Plus)')
+    parser.add_argument('--bulk-delay', type=float, default=0.5, help='seconds a bulk operation stays RUNNING')
+    parser.add_argument('--orders', type=int, default=10)
+    parser.add_argument('--order-lines', type=int, default=5)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help="show the app's own output while scenarios run")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=3)
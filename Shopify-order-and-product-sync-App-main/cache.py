@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows, fall back to in-process locking only
+    fcntl = None
+
+# Seconds between writes of a persistent cache to disk
+CACHE_SAVE_INTERVAL = 60
+
+
+class TTLCache():
+    # Bounded LRU cache whose entries also expire `ttl` seconds after they were stored.
+    # A persistent cache is shared through its file by every process using the same persist_path: invalidations are
+    # written right away, and a process picks up what others wrote the next time it reads after the file changed.
+
+    def __init__(self, maxsize: int, ttl: float, persist_path: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.last_save = time.time()
+        # Entries set in this process since the last save, laid over whatever the file holds
+        self.pending = {}
+        self.file_version = None
+        if persist_path:
+            self.load()
+            atexit.register(self.save)
+
+    def get(self, key, default=None):
+        with self.lock:
+            self._refresh()
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            entry = (time.time() + self.ttl, value)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._trim()
+            save = False
+            if self.persist_path:
+                self.pending[key] = entry
+                save = time.time() - self.last_save >= CACHE_SAVE_INTERVAL
+        if save:
+            self.save()
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+                self.pending.pop(key, None)
+        if self.persist_path and keys:
+            # Written now, so neither a restart nor another process brings the entries back
+            self._sync(remove=keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.pending.clear()
+        if self.persist_path:
+            self._sync(clear=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_ratio': round(self.hits / lookups, 3) if lookups else None}
+
+    def _trim(self):
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _version(self):
+        # Saves replace the file, so its inode changes even when the mtime doesn't
+        try:
+            stat = os.stat(self.persist_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def _refresh(self):
+        if self.persist_path and self._version() != self.file_version:
+            self.load()
+
+    def load(self):
+        # Entries from the file, plus what this process set since its last save
+        with self.lock:
+            self.file_version = self._version()
+            try:
+                with open(self.persist_path, "r") as file:
+                    stored = json.load(file)
+            except FileNotFoundError:
+                stored = []
+            except ValueError:
+                logging.warning(f"Ignoring unreadable cache file {self.persist_path}")
+                stored = []
+            now = time.time()
+            self.entries = OrderedDict((key, (expires_at, value)) for key, expires_at, value in stored if expires_at > now)
+            for key, entry in self.pending.items():
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+            self._trim()
+
+    def save(self):
+        if self.persist_path and self.pending:
+            self._sync()
+
+    def _sync(self, remove: tuple = (), clear: bool = False):
+        # Read-merge-write under the file lock, so no process overwrites another one's entries or invalidations
+        with self._file_lock(), self.lock:
+            if clear:
+                self.entries = OrderedDict()
+            else:
+                self.load()
+                for key in remove:
+                    self.entries.pop(key, None)
+            stored = [(key, expires_at, value) for key, (expires_at, value) in self.entries.items()]
+            tmp_path = f"{self.persist_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(stored, file)
+            os.replace(tmp_path, self.persist_path)
+            self.file_version = self._version()
+            self.pending = {}
+            self.last_save = time.time()
+
+    @contextmanager
+    def _file_lock(self):
+        if not fcntl:
+            yield
+            return
+        with open(f"{self.persist_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
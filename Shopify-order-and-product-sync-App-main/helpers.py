@@ -1,7 +1,11 @@
 from functools import wraps
 from typing import List
+import os
 import logging
 
+import tasks
+from webhook_dedup import delivery_key
+
 import re
 import hmac
 import base64
@@ -42,6 +46,20 @@ def verify_web_call(f):
     return wrapper
 
 
+def verify_metrics_call(f):
+    # The app faces Shopify and the metrics name installed shops, so /metrics stays closed until METRICS_TOKEN is set.
+    # Scrapers then send it as a bearer token. worker.py --metrics-port is meant for the internal network only.
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        token = os.environ.get('METRICS_TOKEN')
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+            abort(401)
+        return f(*args, **kwargs)
+    return wrapper
+
+
 def verify_webhook_call(f):
     @wraps(f)
     def wrapper(*args, **kwargs) -> bool:
@@ -52,10 +70,30 @@ def verify_webhook_call(f):
         if not verify_hmac(data, hmac):
             logging.error(f"HMAC could not be verified: \n\thmac {hmac}\n\tdata {data}")
             abort(401)
-        return f(*args, **kwargs)
+
+        # Shopify redelivers until it gets a 200, a delivery already handled is acknowledged and nothing else
+        key = webhook_delivery_key()
+        deliveries = tasks.webhook_deliveries()
+        if key and not deliveries.claim(key):
+            logging.info(f"Duplicate webhook delivery {key} acknowledged")
+            return "OK"
+        try:
+            return f(*args, **kwargs)
+        except Exception:
+            if key:
+                deliveries.release(key)
+            raise
     return wrapper
 
 
+def webhook_delivery_key() -> str:
+    webhook_id = request.headers.get('X-Shopify-Webhook-Id')
+    if not webhook_id:
+        return None
+    payload = request.get_json(silent=True) or {}
+    return delivery_key(webhook_id, request.headers.get('X-Shopify-Topic'), payload.get('id'))
+
+
 def verify_hmac(data: bytes, orig_hmac: str):
     new_hmac = hmac.new(
         SHOPIFY_SECRET.encode('utf-8'),
@@ -0,0 +1,60 @@
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Number of per-host pools kept per session and keep-alive connections per host.
+# Keep HTTP_POOL_MAXSIZE at or above the sync worker counts, otherwise connections get discarded.
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 32
+# (connect, read) timeout in seconds applied to every call that doesn't pass its own
+HTTP_TIMEOUT = (5, 60)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PooledSession(requests.Session):
+
+    def __init__(self, pool_connections: int = HTTP_POOL_CONNECTIONS, pool_maxsize: int = HTTP_POOL_MAXSIZE, timeout=HTTP_TIMEOUT, name: str = None):
+        super().__init__()
+        # Named sessions record every call in metrics under that upstream
+        self.name = name
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if not self.name:
+            return super().request(method, url, **kwargs)
+        started = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException as ex:
+            metrics.upstream_error(self.name, method, ex)
+            raise
+        metrics.observe_upstream(self.name, method, response.status_code, time.perf_counter() - started)
+        return response
+
+
+def get_session(name: str) -> PooledSession:
+    # One long-lived session per upstream, shared by every client instance and thread
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = PooledSession(name=name)
+        return _sessions[name]
+
+
+def configure_session(name: str, pool_connections: int = HTTP_POOL_CONNECTIONS, pool_maxsize: int = HTTP_POOL_MAXSIZE, timeout=HTTP_TIMEOUT) -> PooledSession:
+    session = PooledSession(pool_connections=pool_connections, pool_maxsize=pool_maxsize, timeout=timeout, name=name)
+    with _sessions_lock:
+        old_session = _sessions.get(name)
+        _sessions[name] = session
+    if old_session:
+        old_session.close()
+    return session
@@ -0,0 +1,312 @@
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+
+import metrics
+import json_codec
+
+# Worker threads per JobRunner
+JOB_WORKERS = 2
+# Seconds an idle worker waits before polling the queue again
+JOB_POLL_INTERVAL = 1.0
+# Running jobs refresh their heartbeat this often, and are requeued once it is JOB_STALE_AFTER old
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_STALE_AFTER = 120
+# A job whose worker died this many times is marked failed instead of requeued
+JOB_MAX_ATTEMPTS = 3
+# Seconds before the first retry of a failed job, doubled on every further retry up to JOB_RETRY_MAX_DELAY
+JOB_RETRY_BACKOFF = 30
+JOB_RETRY_MAX_DELAY = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    queue TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT,
+    status TEXT NOT NULL,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL,
+    run_after REAL,
+    retries INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_queue_status ON jobs (queue, status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_kind_status ON jobs (kind, status);
+"""
+
+# Columns added after the first release, created on databases that predate them
+MIGRATIONS = {
+    'run_after': 'ALTER TABLE jobs ADD COLUMN run_after REAL',
+    'retries': 'ALTER TABLE jobs ADD COLUMN retries INTEGER NOT NULL DEFAULT 0',
+}
+
+JSON_FIELDS = ('payload', 'progress', 'result')
+
+
+class JobQueue():
+
+    _queues = {}
+    _queues_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    conn.execute(statement)
+
+    @classmethod
+    def open(cls, path: str) -> 'JobQueue':
+        with cls._queues_lock:
+            if path not in cls._queues:
+                cls._queues[path] = cls(path)
+            return cls._queues[path]
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        if row is None:
+            return None
+        job = dict(row)
+        for field in JSON_FIELDS:
+            job[field] = json_codec.loads(job[field]) if job[field] else None
+        return job
+
+    def enqueue(self, kind: str, payload: dict = None, queue: str = 'default') -> str:
+        job_id = uuid.uuid4().hex
+        self.connection().execute('INSERT INTO jobs (id, queue, kind, payload, status, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (job_id, queue, kind, json_codec.dumps(payload), 'queued', time.time()))
+        return job_id
+
+    def enqueue_unique(self, kind: str, payload: dict, unique_fields: tuple, queue: str = 'default') -> dict:
+        # Returns the active job of this kind whose payload matches on unique_fields, or queues a new one.
+        # Check and insert share one write transaction, so two concurrent calls can't both queue a job.
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            job = self.active(kind, {field: payload.get(field) for field in unique_fields})
+            job_id = job['id'] if job else self.enqueue(kind, payload, queue=queue)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return job or self.get(job_id)
+
+    def get(self, job_id: str) -> dict:
+        return self._to_dict(self.connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+    def active(self, kind: str, payload_filter: dict = None) -> dict:
+        # Latest queued or running job of a kind, optionally matching payload fields
+        for row in self.connection().execute("SELECT * FROM jobs WHERE kind = ? AND status IN ('queued', 'running') ORDER BY created_at DESC", (kind,)):
+            job = self._to_dict(row)
+            if not payload_filter or all((job['payload'] or {}).get(key) == value for key, value in payload_filter.items()):
+                return job
+        return None
+
+    def latest(self, kind: str, payload_filter: dict = None) -> dict:
+        # Latest job of a kind in any state, optionally matching payload fields
+        if not payload_filter:
+            return self._to_dict(self.connection().execute('SELECT * FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT 1', (kind,)).fetchone())
+        for row in self.connection().execute('SELECT * FROM jobs WHERE kind = ? ORDER BY created_at DESC', (kind,)):
+            job = self._to_dict(row)
+            if all((job['payload'] or {}).get(key) == value for key, value in payload_filter.items()):
+                return job
+        return None
+
+    def claim(self, queue: str, worker: str) -> dict:
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            # Jobs waiting out a retry backoff are left alone until run_after
+            row = conn.execute("SELECT id FROM jobs WHERE queue = ? AND status = 'queued' AND (run_after IS NULL OR run_after <= ?) ORDER BY created_at LIMIT 1",
+                               (queue, now)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, started_at = ?, heartbeat_at = ? WHERE id = ?",
+                         (worker, now, now, row['id']))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return self.get(row['id'])
+
+    def heartbeat(self, job_ids: list):
+        now = time.time()
+        self.connection().executemany("UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'", [(now, job_id) for job_id in job_ids])
+
+    def set_progress(self, job_id: str, progress: dict):
+        self.connection().execute('UPDATE jobs SET progress = ?, heartbeat_at = ? WHERE id = ?', (json_codec.dumps(progress), time.time(), job_id))
+
+    def complete(self, job_id: str, result=None):
+        self.connection().execute("UPDATE jobs SET status = 'done', result = ?, finished_at = ? WHERE id = ?", (json_codec.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id: str, error: str):
+        self.connection().execute("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?", (error, time.time(), job_id))
+
+    def retry(self, job_id: str, error: str, delay: float):
+        # Back in the queue after delay seconds. attempts restarts, it only counts crashed workers within one retry.
+        self.connection().execute("UPDATE jobs SET status = 'queued', error = ?, worker = NULL, attempts = 0, retries = retries + 1, run_after = ? WHERE id = ?",
+                                  (error, time.time() + delay, job_id))
+
+    def dead(self, job_id: str, error: str):
+        # Out of retries, kept as dead letter until redrive() queues it again
+        self.connection().execute("UPDATE jobs SET status = 'dead', error = ?, finished_at = ? WHERE id = ?", (error, time.time(), job_id))
+
+    def redrive(self, queue: str, kind: str = None) -> int:
+        # Queues dead jobs again with a fresh set of retries, e.g. once MYPOS is back
+        sql = "UPDATE jobs SET status = 'queued', worker = NULL, attempts = 0, retries = 0, run_after = NULL, finished_at = NULL WHERE status = 'dead' AND queue = ?"
+        params = (queue,)
+        if kind:
+            sql += ' AND kind = ?'
+            params += (kind,)
+        redriven = self.connection().execute(sql, params).rowcount
+        if redriven:
+            logging.warning(f"Redriving {redriven} dead jobs on queue {queue}")
+        return redriven
+
+    def requeue_stale(self, stale_after: float = JOB_STALE_AFTER, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        # Jobs whose worker stopped heartbeating were orphaned by a crash or restart
+        conn = self.connection()
+        cutoff = time.time() - stale_after
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            failed = conn.execute("UPDATE jobs SET status = 'failed', error = 'Worker died too many times', finished_at = ? WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                                  (time.time(), cutoff, max_attempts)).rowcount
+            requeued = conn.execute("UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat_at < ?", (cutoff,)).rowcount
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if requeued or failed:
+            logging.warning(f"Recovered stale jobs: {requeued} requeued, {failed} failed")
+        return requeued
+
+    def counts(self) -> list:
+        # (queue, kind, status, jobs) for every combination present
+        return [tuple(row) for row in self.connection().execute('SELECT queue, kind, status, COUNT(*) FROM jobs GROUP BY queue, kind, status')]
+
+    def oldest_queued(self) -> dict:
+        # {queue: created_at of its oldest queued job}
+        return dict(tuple(row) for row in self.connection().execute("SELECT queue, MIN(created_at) FROM jobs WHERE status = 'queued' GROUP BY queue"))
+
+
+class JobRunner():
+
+    def __init__(self, queue: JobQueue, handlers: dict, queue_name: str = 'default', workers: int = JOB_WORKERS, retries: int = 0,
+                 retry_if=None):
+        self.queue = queue
+        # Times a failed job is tried again before it becomes a dead letter, 0 fails it right away
+        self.retries = retries
+        # retry_if(exception) tells failures worth another try from ones that fail the same way every time,
+        # the latter become dead letters at once. Every failure is retried without it.
+        self.retry_if = retry_if
+        self.handlers = handlers
+        self.queue_name = queue_name
+        self.workers = workers
+        self.worker_id = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.running_jobs = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self) -> 'JobRunner':
+        self.queue.requeue_stale()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-{self.queue_name}-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name=f'job-{self.queue_name}-heartbeat', daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return self
+
+    def stop(self, timeout: float = None):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def _heartbeat(self):
+        while not self.stopping.wait(JOB_HEARTBEAT_INTERVAL):
+            with self.lock:
+                job_ids = list(self.running_jobs)
+            try:
+                if job_ids:
+                    self.queue.heartbeat(job_ids)
+                self.queue.requeue_stale()
+            except sqlite3.Error as ex:
+                logging.exception(ex)
+
+    def _work(self):
+        while not self.stopping.is_set():
+            try:
+                job = self.queue.claim(self.queue_name, self.worker_id)
+            except sqlite3.Error as ex:
+                logging.exception(ex)
+                job = None
+            if job is None:
+                self.stopping.wait(JOB_POLL_INTERVAL)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job: dict):
+        handler = self.handlers.get(job['kind'])
+        if handler is None:
+            self.queue.fail(job['id'], f"No handler for job kind {job['kind']}")
+            return
+        with self.lock:
+            self.running_jobs.add(job['id'])
+        started = time.monotonic()
+        status = 'failed'
+        try:
+            result = handler(job, lambda progress: self.queue.set_progress(job['id'], progress))
+            self.queue.complete(job['id'], result)
+            status = 'done'
+        except Exception as ex:
+            logging.exception(ex)
+            status = self._failed(job, repr(ex), retryable=self.retry_if is None or self.retry_if(ex))
+        finally:
+            with self.lock:
+                self.running_jobs.discard(job['id'])
+            metrics.JOBS_FINISHED.inc(kind=job['kind'], status=status)
+            metrics.JOB_DURATION.observe(time.monotonic() - started, kind=job['kind'], status=status)
+
+    def _failed(self, job: dict, error: str, retryable: bool = True) -> str:
+        retries = job.get('retries') or 0
+        if retryable and retries < self.retries:
+            delay = min(JOB_RETRY_BACKOFF * 2 ** retries, JOB_RETRY_MAX_DELAY)
+            logging.warning(f"Job {job['id']} ({job['kind']}) failed, retry {retries + 1}/{self.retries} in {delay}s: {error}")
+            self.queue.retry(job['id'], error, delay)
+            return 'retried'
+        if self.retries:
+            if retryable:
+                logging.error(f"Job {job['id']} ({job['kind']}) failed {retries + 1} times, kept as dead letter: {error}")
+            else:
+                logging.error(f"Job {job['id']} ({job['kind']}) failed for good, kept as dead letter: {error}")
+            self.queue.dead(job['id'], error)
+            return 'dead'
+        self.queue.fail(job['id'], error)
+        return 'failed'
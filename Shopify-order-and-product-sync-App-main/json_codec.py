@@ -0,0 +1,44 @@
+import json
+import logging
+
+try:
+    import orjson
+except ImportError:  # Optional, several times faster on big product pages (pip install orjson)
+    orjson = None
+
+# Every JSON the app decodes or stores goes through here, with orjson when it's installed and the json module otherwise.
+# Stored documents (SQLite rows, job records, settings) are compact, only debug dumps get indented.
+
+
+def loads(data):
+    # str or bytes, e.g. response.content, so a response body is decoded exactly once
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        # Non-string keys are turned into strings, the same as json.dumps does
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def pretty(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2).decode('utf-8')
+    return json.dumps(obj, indent=2)
+
+
+def response_json(response):
+    return loads(response.content)
+
+
+def debug_enabled() -> bool:
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def log_debug(message: str, obj):
+    # The dump of a 250 product page costs more than the call's own decode, only build it when it gets logged
+    if debug_enabled():
+        logging.debug(f"{message}:\n{pretty(obj)}")
@@ -0,0 +1,197 @@
+import bisect
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from rate_limiter import ShopifyRateLimiter
+
+# In-process metrics in the Prometheus text format, served by /metrics in the web app and by worker.py --metrics-port.
+# Every process keeps its own numbers, scrape each web and job worker process.
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Histogram buckets in seconds, from a local MYPOS call to a slow bulk download or full sync
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+JOB_DURATION_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0)
+
+_metrics = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric():
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self):
+        with self.lock:
+            return [(self.name, key, None, value) for key, value in self.values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, samples: dict):
+        # Swaps in a full set of {label values tuple: value}, so labels that went away stop being exported
+        samples = {tuple(str(value) for value in key): value for key, value in samples.items()}
+        with self.lock:
+            self.values = samples
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.lock:
+            # [count per bucket..., count above the last bucket, sum]
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def _samples(self):
+        with self.lock:
+            values = {key: list(series) for key, series in self.values.items()}
+        samples = []
+        for key, series in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key, f'le="{_format_value(bound)}"', cumulative))
+            samples.append((f"{self.name}_sum", key, None, series[-1]))
+            samples.append((f"{self.name}_count", key, None, cumulative))
+        return samples
+
+
+def add_collector(collector):
+    # collector() runs on every scrape, for gauges read from state elsewhere (rate buckets, the job database)
+    with _registry_lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+
+def render() -> str:
+    with _registry_lock:
+        collectors = list(_collectors)
+        metrics = list(_metrics)
+    for collector in collectors:
+        try:
+            collector()
+        except Exception as ex:
+            # A broken collector must not take the whole scrape down
+            logging.exception(ex)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Upstream API calls, recorded per attempt by the HTTP sessions, so throttled retries show up as 429s
+UPSTREAM_REQUESTS = Counter('upstream_requests_total', 'Calls to Shopify and MYPOS by status code', ('upstream', 'method', 'status'))
+UPSTREAM_LATENCY = Histogram('upstream_request_duration_seconds', 'Time until the upstream answered', ('upstream', 'method'))
+UPSTREAM_ERRORS = Counter('upstream_request_errors_total', 'Calls that got no response at all', ('upstream', 'method', 'error'))
+SHOPIFY_BUCKET_USED = Gauge('shopify_call_bucket_used', 'Calls in the shop\'s leaky bucket as this process sees it', ('shop',))
+SHOPIFY_BUCKET_CAPACITY = Gauge('shopify_call_bucket_capacity', 'Size of the shop\'s leaky bucket', ('shop',))
+
+# Flask routes, labelled by rule rather than path so ids in the URL don't explode the series
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'Time spent answering web app requests', ('route', 'method', 'status'))
+
+# Background jobs and what they get through
+JOBS_FINISHED = Counter('jobs_finished_total', 'Jobs run by this process', ('kind', 'status'))
+JOB_DURATION = Histogram('job_duration_seconds', 'Time from claiming a job to finishing it', ('kind', 'status'), buckets=JOB_DURATION_BUCKETS)
+JOBS = Gauge('jobs', 'Jobs in the job database by state', ('queue', 'kind', 'status'))
+JOBS_OLDEST_QUEUED = Gauge('jobs_oldest_queued_age_seconds', 'How long the oldest queued job has been waiting', ('queue',))
+SYNC_VARIANTS = Counter('sync_variants_total', 'Variants handled by stock syncs', ('result',))
+PRODUCTS_LOADED = Counter('products_loaded_total', 'Products stored by load jobs', ('mode',))
+
+
+def observe_upstream(upstream: str, method: str, status: int, seconds: float):
+    method = method.upper()
+    UPSTREAM_REQUESTS.inc(upstream=upstream, method=method, status=status)
+    UPSTREAM_LATENCY.observe(seconds, upstream=upstream, method=method)
+
+
+def upstream_error(upstream: str, method: str, error: BaseException):
+    UPSTREAM_ERRORS.inc(upstream=upstream, method=method.upper(), error=type(error).__name__)
+
+
+def _collect_rate_buckets():
+    usage = ShopifyRateLimiter.usage_by_shop()
+    SHOPIFY_BUCKET_USED.replace({(shop,): bucket['used'] for shop, bucket in usage.items()})
+    SHOPIFY_BUCKET_CAPACITY.replace({(shop,): bucket['capacity'] for shop, bucket in usage.items()})
+
+
+add_collector(_collect_rate_buckets)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int, host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    # For processes without Flask (worker.py): any GET returns the metrics, served on a daemon thread
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
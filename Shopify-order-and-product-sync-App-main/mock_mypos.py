@@ -0,0 +1,117 @@
+import time
+import uuid
+import logging
+import argparse
+import threading
+from collections import Counter
+
+from flask import Flask, request, abort
+from werkzeug.serving import make_server
+
+from shopify_client import MYPOS_STOCK_NAME
+
+# Stand-in for the MYPOS Connect endpoints the app calls. Product codes follow mock_shopify's SKUs,
+# so the two together make a catalog the sync can run against.
+# Point a client at it with MYPOSConnectClient(..., api_url=mypos.api_url).
+
+
+class MockMYPOS():
+
+    def __init__(self, products: int = 1000, variants_per_product: int = 3, latency: float = 0.0, missing_every: int = 0,
+                 lost_sales: int = 0):
+        # latency is added to every call, every missing_every-th product code is left out of the catalog,
+        # the next lost_sales sale posts are booked but answered 503, like a response lost after MYPOS took the sale
+        self.latency = latency
+        self.lost_sales = lost_sales
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.token = uuid.uuid4().hex
+        self.products = {}
+        for index in range(products):
+            for position in range(variants_per_product):
+                number = index * variants_per_product + position
+                if missing_every and number % missing_every == 0:
+                    continue
+                productCode = f"SKU-{index}-{position}"
+                self.products[productCode] = {'productId': str(uuid.UUID(int=number + 1)), 'productCode': productCode,
+                                              'longDescription': f"Product {index} variant {position}", 'shortDescription': f"P{index}-{position}",
+                                              'storeStocks': [{'name': MYPOS_STOCK_NAME, 'quantity': number % 25 + 1}]}
+        self.codes = list(self.products)
+        self.sales = []
+        self.customers = 0
+        self.api_url = None
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+
+def create_app(mypos: MockMYPOS) -> Flask:
+    app = Flask(__name__)
+
+    @app.before_request
+    def check_token():
+        if mypos.latency:
+            time.sleep(mypos.latency)
+        if request.path != '/auth/token' and request.headers.get('Authorization') != f"Bearer {mypos.token}":
+            abort(401)
+
+    @app.route('/auth/token', methods=['POST'])
+    def auth_token():
+        mypos.count('auth/token')
+        return {'bearerToken': mypos.token}
+
+    @app.route('/products', methods=['GET'])
+    def products():
+        mypos.count('products')
+        page_size = int(request.args.get('pageSize', 100))
+        start = (int(request.args.get('pageNumber', 1)) - 1) * page_size
+        return {'products': [mypos.products[productCode] for productCode in mypos.codes[start:start + page_size]]}
+
+    @app.route('/products/<productCode>', methods=['GET'])
+    def product(productCode):
+        mypos.count('products/<code>')
+        if productCode not in mypos.products:
+            abort(404)
+        return mypos.products[productCode]
+
+    @app.route('/customers', methods=['POST'])
+    def customers():
+        mypos.count('customers')
+        with mypos.lock:
+            mypos.customers += 1
+        return dict(request.get_json(), customerId=str(uuid.uuid4()))
+
+    @app.route('/saleitems', methods=['POST'])
+    def saleitems():
+        mypos.count('saleitems')
+        with mypos.lock:
+            mypos.sales.append(request.get_json())
+            if mypos.lost_sales > 0:
+                mypos.lost_sales -= 1
+                abort(503)
+        return '', 202
+
+    return app
+
+
+def run_server(mypos: MockMYPOS, host: str = '127.0.0.1', port: int = 0):
+    # Serves the mock on a background thread, port 0 picks a free one. Returns the werkzeug server, call shutdown() to stop.
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(host, port, create_app(mypos), threaded=True)
+    mypos.api_url = f"http://{host}:{server.server_port}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a fake MYPOS Connect API')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--variants', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    mypos = MockMYPOS(args.products, args.variants, latency=args.latency)
+    print(f"Mock MYPOS API at http://127.0.0.1:{args.port}/, bearer token {mypos.token}")
+    create_app(mypos).run(port=args.port, threaded=True)
@@ -0,0 +1,256 @@
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import Counter
+
+from flask import Flask, Response, request, abort, g
+from werkzeug.serving import make_server
+
+# Stand-in for the parts of the Shopify Admin API the app uses, for exercising the loaders and the sync
+# without a real store. Point a client at it with ShopifyStoreClient(..., api_url=shop.api_url).
+
+MOCK_API_VERSION = "2020-10"
+MOCK_GRAPHQL_API_VERSION = "2024-04"
+# Leaky bucket the mock enforces with 429s, Shopify's standard plan by default
+MOCK_BUCKET_SIZE = 40
+MOCK_LEAK_RATE = 2.0
+
+
+class MockShop():
+
+    def __init__(self, products: int = 1000, variants_per_product: int = 3, latency: float = 0.0, bulk_delay: float = 0.0,
+                 bucket_size: int = MOCK_BUCKET_SIZE, leak_rate: float = MOCK_LEAK_RATE, graphql_throttled: int = 0):
+        # latency is added to every API call, bulk_delay is how long a bulk operation stays RUNNING,
+        # graphql_throttled is how many of the next GraphQL calls are answered THROTTLED,
+        # bulk_busy refuses bulk operations like Shopify does while another one runs for the app
+        self.latency = latency
+        self.bulk_delay = bulk_delay
+        self.bucket_size = bucket_size
+        self.leak_rate = leak_rate
+        self.graphql_throttled = graphql_throttled
+        self.bulk_busy = False
+        self.bucket_used = 0.0
+        self.bucket_updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.products = [self._product(index, variants_per_product) for index in range(products)]
+        self.levels = {variant['inventory_item_id']: 0 for product in self.products for variant in product['variants']}
+        self.bulk_operations = {}
+        self.current_bulk = None
+        self.webhooks = []
+        self.access_token = 'mock-access-token'
+        self.api_url = None
+        self.oauth_url = None
+
+    @staticmethod
+    def _product(index: int, variants_per_product: int) -> dict:
+        product_id = 1000 + index
+        return {'id': product_id, 'title': f"Product {index}", 'handle': f"product-{index}", 'vendor': 'Mock',
+                'product_type': 'Toy', 'tags': 'mypos', 'created_at': '2020-10-01T00:00:00-04:00',
+                'updated_at': '2020-10-01T00:00:00-04:00',
+                'variants': [{'id': product_id * 100 + position, 'product_id': product_id, 'title': f"Variant {position}",
+                              'sku': f"SKU-{index}-{position}", 'price': '9.99', 'barcode': None, 'position': position + 1,
+                              'inventory_item_id': product_id * 1000 + position}
+                             for position in range(variants_per_product)]}
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def take_call(self):
+        # (allowed, calls in the bucket) like Shopify's X-Shopify-Shop-Api-Call-Limit
+        with self.lock:
+            now = time.monotonic()
+            self.bucket_used = max(0.0, self.bucket_used - (now - self.bucket_updated) * self.leak_rate)
+            self.bucket_updated = now
+            if self.bucket_used + 1 > self.bucket_size:
+                self.calls['429'] += 1
+                return False, int(self.bucket_used)
+            self.bucket_used += 1
+            return True, int(self.bucket_used)
+
+    def take_graphql_throttle(self) -> bool:
+        with self.lock:
+            if self.graphql_throttled <= 0:
+                return False
+            self.graphql_throttled -= 1
+            self.calls['throttled'] += 1
+            return True
+
+    def set_quantities(self, variables: dict) -> dict:
+        # All or nothing like Shopify: any unknown item or stale compareQuantity is reported by index and nothing is written
+        quantities = variables['input']['quantities']
+        errors = []
+        with self.lock:
+            for index, quantity in enumerate(quantities):
+                inventory_item_id = int(quantity['inventoryItemId'].rsplit('/', 1)[1])
+                if inventory_item_id not in self.levels:
+                    errors.append({'field': ['input', 'quantities', str(index), 'inventoryItemId'],
+                                   'message': 'The specified inventory item could not be found.', 'code': 'INVALID_INVENTORY_ITEM'})
+                elif quantity.get('compareQuantity') is not None and self.levels[inventory_item_id] != quantity['compareQuantity']:
+                    errors.append({'field': ['input', 'quantities', str(index), 'compareQuantity'],
+                                   'message': 'The compareQuantity argument no longer matches the persisted quantity.', 'code': 'COMPARE_QUANTITY_STALE'})
+            if errors:
+                return {'inventoryAdjustmentGroup': None, 'userErrors': errors}
+            for quantity in quantities:
+                self.levels[int(quantity['inventoryItemId'].rsplit('/', 1)[1])] = quantity['quantity']
+            self.calls['inventorySetQuantities'] += 1
+            group_id = f"gid://shopify/InventoryAdjustmentGroup/{self.calls['inventorySetQuantities']}"
+        return {'inventoryAdjustmentGroup': {'id': group_id}, 'userErrors': []}
+
+    # Bulk operations
+
+    def start_bulk(self) -> dict:
+        with self.lock:
+            operation_id = f"gid://shopify/BulkOperation/{len(self.bulk_operations) + 1}"
+            self.bulk_operations[operation_id] = time.monotonic()
+            self.current_bulk = operation_id
+        return {'id': operation_id, 'status': 'CREATED'}
+
+    def bulk_status(self, host_url: str) -> dict:
+        operation_id = self.current_bulk
+        if not operation_id:
+            return None
+        done = time.monotonic() - self.bulk_operations[operation_id] >= self.bulk_delay
+        return {'id': operation_id, 'status': 'COMPLETED' if done else 'RUNNING', 'errorCode': None,
+                'objectCount': str(sum(1 + len(product['variants']) for product in self.products) if done else 0),
+                'url': f"{host_url}bulk/{operation_id.rsplit('/', 1)[1]}.jsonl" if done else None}
+
+    def iter_bulk_rows(self):
+        for product in self.products:
+            product_gid = f"gid://shopify/Product/{product['id']}"
+            yield {'id': product_gid, 'legacyResourceId': str(product['id']), 'title': product['title'],
+                   'handle': product['handle'], 'vendor': product['vendor'], 'productType': product['product_type'],
+                   'tags': product['tags'].split(', '), 'createdAt': '2020-10-01T04:00:00Z', 'updatedAt': '2020-10-01T04:00:00Z'}
+            for variant in product['variants']:
+                yield {'id': f"gid://shopify/ProductVariant/{variant['id']}", 'legacyResourceId': str(variant['id']),
+                       'sku': variant['sku'], 'title': variant['title'], 'price': variant['price'], 'barcode': variant['barcode'],
+                       'position': variant['position'], 'inventoryItem': {'legacyResourceId': str(variant['inventory_item_id'])},
+                       '__parentId': product_gid}
+
+
+def create_app(shop: MockShop) -> Flask:
+    app = Flask(__name__)
+    api = f"/admin/api/{MOCK_API_VERSION}/"
+    graphql_api = f"/admin/api/{MOCK_GRAPHQL_API_VERSION}/"
+
+    @app.before_request
+    def simulate_latency():
+        if not request.path.startswith((api, graphql_api)):
+            return None
+        if shop.latency:
+            time.sleep(shop.latency)
+        allowed, g.bucket_used = shop.take_call()
+        if not allowed:
+            return Response('{"errors": "Exceeded 2 calls per second for api client. Reduce request rates to resume uninterrupted service."}',
+                            status=429, mimetype='application/json', headers={'Retry-After': '1.0'})
+
+    @app.after_request
+    def call_limit_header(response):
+        if 'bucket_used' in g:
+            response.headers['X-Shopify-Shop-Api-Call-Limit'] = f"{g.bucket_used}/{shop.bucket_size}"
+        return response
+
+    @app.route('/admin/oauth/access_token', methods=['POST'])
+    def oauth_access_token():
+        shop.count('oauth/access_token')
+        if not (request.get_json() or {}).get('code'):
+            abort(400)
+        return {'access_token': shop.access_token, 'scope': 'read_products,write_inventory'}
+
+    @app.route(f"{api}webhooks.json", methods=['POST'])
+    def webhooks():
+        shop.count('webhooks.json')
+        with shop.lock:
+            webhook = dict(request.get_json()['webhook'], id=len(shop.webhooks) + 1)
+            shop.webhooks.append(webhook)
+        return {'webhook': webhook}, 201
+
+    @app.route(f"{api}products.json", methods=['GET'])
+    def products():
+        shop.count('products.json')
+        limit = min(int(request.args.get('limit', 50)), 250)
+        start = int(request.args.get('page_info', 0))
+        page = shop.products[start:start + limit]
+        if request.args.get('fields') == 'id':
+            page = [{'id': product['id']} for product in page]
+        response = Response(json.dumps({'products': page}), mimetype='application/json')
+        if start + limit < len(shop.products):
+            response.headers['Link'] = f'<{request.host_url.rstrip("/")}{api}products.json?limit={limit}&page_info={start + limit}>; rel="next"'
+        return response
+
+    @app.route(f"{api}products/count.json", methods=['GET'])
+    def products_count():
+        shop.count('products/count.json')
+        return {'count': len(shop.products)}
+
+    @app.route(f"{api}inventory_levels.json", methods=['GET'])
+    def inventory_levels():
+        shop.count('inventory_levels.json')
+        ids = [int(inventory_item_id) for inventory_item_id in request.args.get('inventory_item_ids', '').split(',') if inventory_item_id]
+        return {'inventory_levels': [{'inventory_item_id': inventory_item_id, 'location_id': 1, 'available': shop.levels[inventory_item_id]}
+                                     for inventory_item_id in ids if inventory_item_id in shop.levels]}
+
+    @app.route(f"{api}inventory_levels/set.json", methods=['POST'])
+    def inventory_levels_set():
+        shop.count('inventory_levels/set.json')
+        payload = request.get_json()
+        if payload.get('inventory_item_id') not in shop.levels:
+            abort(404)
+        shop.levels[payload['inventory_item_id']] = payload['available']
+        return {'inventory_level': payload}
+
+    @app.route(f"{graphql_api}graphql.json", methods=['POST'])
+    def graphql():
+        shop.count('graphql.json')
+        body = request.get_json()
+        query = body.get('query', '')
+        if shop.take_graphql_throttle():
+            # Shopify answers 200 with the cost of the query and what is left in the bucket
+            return {'errors': [{'message': 'Throttled', 'extensions': {'code': 'THROTTLED', 'documentation': 'https://shopify.dev/api/usage/rate-limits'}}],
+                    'extensions': {'cost': {'requestedQueryCost': 10, 'actualQueryCost': None,
+                                            'throttleStatus': {'maximumAvailable': 1000.0, 'currentlyAvailable': 0, 'restoreRate': 50.0}}}}
+        if 'inventorySetQuantities' in query:
+            return {'data': {'inventorySetQuantities': shop.set_quantities(body.get('variables') or {})}}
+        if 'bulkOperationRunQuery' in query:
+            if shop.bulk_busy:
+                return {'data': {'bulkOperationRunQuery': {'bulkOperation': None, 'userErrors': [
+                    {'field': None, 'message': 'A bulk query operation for this app and shop is already in progress.'}]}}}
+            return {'data': {'bulkOperationRunQuery': {'bulkOperation': shop.start_bulk(), 'userErrors': []}}}
+        if 'currentBulkOperation' in query:
+            return {'data': {'currentBulkOperation': shop.bulk_status(request.host_url)}}
+        return {'errors': [{'message': 'Query not supported by mock_shopify'}]}
+
+    @app.route('/bulk/<operation>.jsonl', methods=['GET'])
+    def bulk_result(operation):
+        shop.count('bulk download')
+        return Response((json.dumps(row) + "\n" for row in shop.iter_bulk_rows()), mimetype='application/jsonl')
+
+    return app
+
+
+def run_server(shop: MockShop, host: str = '127.0.0.1', port: int = 0):
+    # Serves the mock on a background thread, port 0 picks a free one. Returns the werkzeug server, call shutdown() to stop.
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(host, port, create_app(shop), threaded=True)
+    shop.api_url = f"http://{host}:{server.server_port}/admin/api/{MOCK_API_VERSION}/"
+    shop.oauth_url = f"http://{host}:{server.server_port}/admin/oauth/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a fake Shopify Admin API')
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--variants', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bucket-size', type=int, default=MOCK_BUCKET_SIZE)
+    parser.add_argument('--leak-rate', type=float, default=MOCK_LEAK_RATE)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    shop = MockShop(args.products, args.variants, latency=args.latency, bucket_size=args.bucket_size, leak_rate=args.leak_rate)
+    print(f"Mock Shopify API at http://127.0.0.1:{args.port}/admin/api/{MOCK_API_VERSION}/")
+    create_app(shop).run(port=args.port, threaded=True)
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows, fall back to in-process locking only
+    fcntl = None
+
+# MYPOS doesn't report an expiry, bearer tokens are treated as valid for this long
+MYPOS_TOKEN_TTL = 60 * 60
+# Refresh this many seconds before the token is assumed to expire
+MYPOS_TOKEN_REFRESH_MARGIN = 5 * 60
+
+date_format = "%m-%d-%Y %H:%M:%S"
+
+
+class MYPOSTokenManager():
+
+    _managers = {}
+    _managers_lock = threading.Lock()
+
+    def __init__(self, path: str, authenticate, ttl: float = MYPOS_TOKEN_TTL, refresh_margin: float = MYPOS_TOKEN_REFRESH_MARGIN):
+        self.path = path
+        self.authenticate = authenticate
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path: str, authenticate) -> 'MYPOSTokenManager':
+        # One manager per token file, shared by every client in the process
+        with cls._managers_lock:
+            if path not in cls._managers:
+                cls._managers[path] = cls(path, authenticate)
+            return cls._managers[path]
+
+    def _fresh(self, expires_at: float) -> bool:
+        return time.time() < expires_at - self.refresh_margin
+
+    def cached_token(self) -> str:
+        # The in-memory token if it is still fresh, never blocks. Read once, invalidate() may clear it meanwhile.
+        token, expires_at = self.token, self.expires_at
+        if token and self._fresh(expires_at):
+            return token
+        return None
+
+    def get_token(self) -> str:
+        token = self.cached_token()
+        if token:
+            return token
+        with self.lock:
+            if self.token and self._fresh(self.expires_at):
+                return self.token
+            with self._file_lock():
+                # Another worker process may have refreshed it already
+                token, expires_at = self._read()
+                if not token or not self._fresh(expires_at):
+                    token = self.authenticate()
+                    if not token:
+                        raise RuntimeError("MYPOS authentication failed")
+                    expires_at = time.time() + self.ttl
+                    self._write(token, expires_at)
+                    logging.info("MYPOS bearer token refreshed")
+            self.token, self.expires_at = token, expires_at
+            return token
+
+    def invalidate(self, token: str):
+        # Called after a 401, only drop the token if nobody has replaced it yet
+        with self.lock:
+            if self.token != token:
+                return
+            self.token, self.expires_at = None, 0.0
+            with self._file_lock():
+                stored_token, _ = self._read()
+                if stored_token == token:
+                    self._write(None, 0.0)
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as token_file:
+                data = json.load(token_file)
+        except (OSError, ValueError):
+            return None, 0.0
+        expires_at = data.get('expiresAt')
+        if expires_at is None and data.get('lastLoginTime'):
+            # Written by the old hourly cache
+            expires_at = datetime.strptime(data['lastLoginTime'], date_format).timestamp() + self.ttl
+        return data.get('bearerToken'), expires_at or 0.0
+
+    def _write(self, token: str, expires_at: float):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as token_file:
+            json.dump({'bearerToken': token, 'expiresAt': expires_at,
+                       'lastLoginTime': datetime.now().strftime(date_format)}, token_file)
+        os.replace(tmp_path, self.path)
+
+    def _file_lock(self):
+        return _FileLock(f"{self.path}.lock")
+
+
+class _FileLock():
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if fcntl:
+            self.file = open(self.path, "a")
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
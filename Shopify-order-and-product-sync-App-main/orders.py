@@ -0,0 +1,222 @@
+import uuid
+import logging
+
+from shopify_client import MYPOSConnectClient
+
+
+def process_order(order: dict, mypos_client: MYPOSConnectClient, booking: dict = None, save_booking=None):
+    # Books a fulfilled Shopify order into MYPOS as a customer plus one sale. booking carries the customerId and
+    # receiptId of an earlier attempt at the same order, and save_booking(booking) is called before the sale is
+    # posted, so a retried job books the order under the same customer and receipt instead of a second time.
+    # Returns the receiptId, or None when none of the order's products are known to MYPOS.
+    customerJson = {}
+
+    #Add customer
+    customerJson['firstName'] = order['customer']['first_name']
+    customerJson['lastName'] = order['customer']['last_name']
+    customerJson['address'] = None
+    customerJson['city'] = None
+    customerJson['region'] = None
+    customerJson['postalCode'] = None
+    customerJson['country'] = None
+    customerJson['phoneNumber'] = None
+    customerJson['emailAddress'] = None
+    customerJson['active'] = True
+    customerJson['specificPrices'] = []
+
+    payload = {"items":[]}
+    line_items = order['line_items']
+
+    #Same for all items
+    creationDate = order['created_at'][:-6]+'.00'
+    OrderId = order['order_number']
+    SessionId = uuid.uuid4().hex
+    sessionCode = 'SY-' + creationDate[:10]
+
+    # Check for tax lines in parent wrapper
+    if 'tax_lines' in order:
+        if order['tax_lines']:
+            TaxHead = order['tax_lines'][0]
+            Tax = TaxHead
+        else:
+            TaxHead = None
+    else:
+        TaxHead = Tax = None
+
+    # Look every SKU up at once, the order waits for the slowest lookup rather than the sum of them
+    mypos_products = mypos_client.get_products_by_code([item['sku'] for item in line_items if item['sku']], metadata_only=True)
+
+    #Specific for all items
+    for item in line_items:
+        #MYPOS_check1, MYPOS_check2 = False, False
+        SKU = item['sku']
+        mypos = mypos_products.get(SKU)
+        if mypos:
+
+            # Check for tax lines in item wrapper
+            if not TaxHead:
+                if item['tax_lines']:
+                    Tax = item['tax_lines'][0]
+                else:
+                    Tax = {'price':0,'rate':0}
+            TaxValue = Tax['price']
+            TaxRate = Tax['rate']*100
+            Price = item['price']
+            Quantity = item['quantity']
+            load = {}
+            load['creationUser'] = "Taj Test"
+            load['creationDate'] = creationDate
+            load['creationDevice'] = "Shopify MYPOS Connector App"
+            load['effectiveDate'] = creationDate
+            load['sessionId'] = SessionId
+            load['sessionCode'] = sessionCode
+            load['itemDescription'] = mypos['longDescription']
+            load['itemShortDescription'] = mypos['shortDescription']
+            load['promotionCode'] = ""
+            load['rewardPoints'] = None
+
+            load['itemPrice'] = float(Price)
+            load['itemValue'] = float(Price)
+            load['itemCurValue'] = float(Price)
+            load['overrideValue'] = None
+
+            load['reasonCodeType'] = ""
+            load['isTransferred'] = True
+            load['transferDate'] = creationDate
+            load['posted'] = 'X'
+            load['printed'] = 1
+
+            load['taxRate'] = float(TaxRate)
+            load['taxValue'] = float(TaxValue)
+            load['taxCode'] = f'{int(TaxRate)}%'
+            load['isTaxable'] = item['taxable']
+
+            load['commissionValue'] = 0.00000
+            load['commissionType'] = None
+            load['bacsId'] = None
+            load['paymentAttempts'] = None
+            load['currencyCode'] = "GBP"
+            load['itemCode'] = SKU
+            load['productId'] = mypos['productId']
+            load['quantity'] = Quantity
+            load['stockQuantity'] = None
+            load['stockAdjustmentId'] = None
+            load['printSort'] = 0
+            load['modifierGroup'] = ""
+            load['cardTransactionInfo01'] = None
+            load['cardTransactionInfo02'] = None
+            load['linkedPurchaseOrderItemId'] = None
+            load['itemSubType'] = None
+            load['linkedSaleItemId'] = "00000000-0000-0000-0000-000000000000"
+
+
+            load['cC_001'] = ""
+            load['cC_002'] = ""
+            load['cC_003'] = ""
+            load['cC_004'] = ""
+            load['cC_005'] = ""
+            load['cC_006'] = None
+            load['cC_007'] = None
+            load['cC_008'] = None
+            load['cC_009'] = None
+            load['cC_010'] = None
+
+            load['receiptId'] = ''
+            load['receiptCode'] = ''
+            load['itemType'] = 'P'
+
+            payload["items"].append(load)
+
+            #Add out-balancing item
+            load = {}
+            load['creationUser'] = "Taj Test"
+            load['creationDate'] = creationDate
+            load['creationDevice'] = "Shopify MYPOS Connector App"
+            load['effectiveDate'] = creationDate
+            load['sessionId'] = SessionId
+            load['sessionCode'] = sessionCode
+            load['itemDescription'] = "Payment made on Shopify"
+            load['itemShortDescription'] = "Payment Shopify"
+            load['promotionCode'] = ""
+            load['rewardPoints'] = None
+
+            load['itemPrice'] = -float(Price)
+            load['itemValue'] = -float(Price)
+            load['itemCurValue'] = -float(Price)
+            load['overrideValue'] = None
+
+            load['reasonCodeType'] = ""
+            load['isTransferred'] = True
+            load['transferDate'] = creationDate
+            load['posted'] = 'X'
+            load['printed'] = 1
+
+            load['taxRate'] = float(TaxRate)
+            load['taxValue'] = float(TaxValue)
+            load['taxCode'] = f'{int(TaxRate)}%'
+            load['isTaxable'] = item['taxable']
+
+            load['commissionValue'] = 0.00000
+            load['commissionType'] = None
+            load['bacsId'] = None
+            load['paymentAttempts'] = None
+            load['currencyCode'] = "GBP"
+            load['itemCode'] = "Shopify"
+            load['quantity'] = Quantity
+            load['stockQuantity'] = None
+            load['stockAdjustmentId'] = None
+            load['printSort'] = 0
+            load['modifierGroup'] = ""
+            load['cardTransactionInfo01'] = None
+            load['cardTransactionInfo02'] = None
+            load['linkedPurchaseOrderItemId'] = None
+            load['itemSubType'] = None
+            load['linkedSaleItemId'] = "00000000-0000-0000-0000-000000000000"
+
+
+            load['cC_001'] = ""
+            load['cC_002'] = ""
+            load['cC_003'] = ""
+            load['cC_004'] = ""
+            load['cC_005'] = ""
+            load['cC_006'] = None
+            load['cC_007'] = None
+            load['cC_008'] = None
+            load['cC_009'] = None
+            load['cC_010'] = None
+
+            load['receiptId'] = ''
+            load['receiptCode'] = ''
+            load['itemType'] = 'R'
+
+            payload["items"].append(load)
+
+        else:
+            print("Not in MYPOS")
+
+    if not payload["items"]:
+        logging.warning(f"Order {OrderId} has no products known to MYPOS, nothing booked")
+        return None
+
+    booking = dict(booking or {})
+    if not booking.get('customerId'):
+        customer = mypos_client.create_customer(payload=customerJson)
+        if not customer:
+            raise RuntimeError(f"MYPOS rejected the customer of order {OrderId}")
+        booking['customerId'] = customer['customerId']
+    if not booking.get('receiptId'):
+        booking['receiptId'] = uuid.uuid4().hex
+    if save_booking:
+        save_booking(booking)
+    # One receipt per order, a resent sale carries the same receiptId and receiptCode
+    receiptCode = f'SY-{OrderId}'
+    for item in payload["items"]:
+        item['customerId'] = booking['customerId']
+        item['receiptId'] = booking['receiptId']
+        item['receiptCode'] = receiptCode
+
+    saleitem = mypos_client.create_saleitem(payload=payload)
+    if not saleitem:
+        raise RuntimeError(f"MYPOS rejected the sale of order {OrderId}")
+    logging.info(f'saleitem:{saleitem}')
+    return saleitem
@@ -0,0 +1,271 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+import json_codec
+
+# Products written per transaction when syncing / importing
+STORE_BATCH_SIZE = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    updated_at TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS variants (
+    id INTEGER PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    sku TEXT,
+    inventory_item_id INTEGER,
+    position INTEGER,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS variants_product_id ON variants (product_id);
+CREATE INDEX IF NOT EXISTS variants_sku ON variants (sku);
+CREATE INDEX IF NOT EXISTS variants_inventory_item_id ON variants (inventory_item_id);
+CREATE TABLE IF NOT EXISTS sync_status (
+    variant_id INTEGER PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    error INTEGER NOT NULL DEFAULT 0,
+    warning INTEGER NOT NULL DEFAULT 0,
+    message TEXT,
+    synced_at TEXT
+);
+CREATE INDEX IF NOT EXISTS sync_status_product_id ON sync_status (product_id);
+CREATE TABLE IF NOT EXISTS pushed_levels (
+    inventory_item_id INTEGER PRIMARY KEY,
+    quantity INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _parse_timestamp(value):
+    # Shopify timestamps carry their own offset, compare them as moments rather than strings
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+
+class ProductStore():
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.files_checked = False
+        with self.write_lock, self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, path: str) -> 'ProductStore':
+        # One store per database file for the whole process
+        with cls._stores_lock:
+            if path not in cls._stores:
+                cls._stores[path] = cls(path)
+            return cls._stores[path]
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _write(self, func, *args):
+        with self.write_lock:
+            conn = self.connection()
+            with conn:
+                return func(conn, *args)
+
+    # Products
+
+    def upsert_products(self, products: list):
+        self._write(self._upsert_products, products)
+
+    @staticmethod
+    def _upsert_products(conn: sqlite3.Connection, products: list):
+        for product in products:
+            variants = product.get('variants') or []
+            productData = {key: value for key, value in product.items() if key != 'variants'}
+            conn.execute('INSERT OR REPLACE INTO products (id, updated_at, data) VALUES (?, ?, ?)',
+                         (product['id'], product.get('updated_at'), json_codec.dumps(productData)))
+            conn.execute('DELETE FROM variants WHERE product_id = ?', (product['id'],))
+            conn.executemany('INSERT OR REPLACE INTO variants (id, product_id, sku, inventory_item_id, position, data) VALUES (?, ?, ?, ?, ?, ?)',
+                             [(variant['id'], product['id'], variant.get('sku'), variant.get('inventory_item_id'), position, json_codec.dumps(variant))
+                              for position, variant in enumerate(variants)])
+
+    def upsert_product_if_newer(self, product: dict) -> bool:
+        # Webhook deliveries can be handled out of order, an older version never replaces a newer one.
+        # Returns False when the stored row was newer and the product was left alone.
+        return self._write(self._upsert_product_if_newer, product)
+
+    @classmethod
+    def _upsert_product_if_newer(cls, conn: sqlite3.Connection, product: dict) -> bool:
+        # Read and write in one write transaction, another process can't slip in between
+        conn.execute('BEGIN IMMEDIATE')
+        row = conn.execute('SELECT updated_at FROM products WHERE id = ?', (product['id'],)).fetchone()
+        stored_at = _parse_timestamp(row[0]) if row else None
+        updated_at = _parse_timestamp(product.get('updated_at'))
+        try:
+            if stored_at and updated_at and updated_at < stored_at:
+                return False
+        except TypeError:
+            # One of them without an offset, can't tell which is newer so take the delivery
+            pass
+        cls._upsert_products(conn, [product])
+        return True
+
+    def append_variants(self, product_id: int, variants: list):
+        # Adds variants to a product already in the store without touching the ones it has
+        self._write(lambda conn: conn.executemany(
+            'INSERT OR REPLACE INTO variants (id, product_id, sku, inventory_item_id, position, data) VALUES (?, ?, ?, ?, ?, ?)',
+            [(variant['id'], product_id, variant.get('sku'), variant.get('inventory_item_id'), (variant.get('position') or 1) - 1, json_codec.dumps(variant))
+             for variant in variants]))
+
+    def delete_products(self, product_ids: list):
+        self._write(self._delete_products, product_ids)
+
+    @staticmethod
+    def _delete_products(conn: sqlite3.Connection, product_ids: list):
+        rows = [(product_id,) for product_id in product_ids]
+        conn.executemany('DELETE FROM products WHERE id = ?', rows)
+        conn.executemany('DELETE FROM variants WHERE product_id = ?', rows)
+        conn.executemany('DELETE FROM sync_status WHERE product_id = ?', rows)
+
+    def count_products(self) -> int:
+        return self.connection().execute('SELECT COUNT(*) FROM products').fetchone()[0]
+
+    def iter_products(self, batch_size: int = STORE_BATCH_SIZE):
+        # Yields (productId, {productId: [variants]}), the same shape the sync engine used to read from disk
+        conn = self.connection()
+        last_id = 0
+        while True:
+            product_ids = [row[0] for row in conn.execute('SELECT id FROM products WHERE id > ? ORDER BY id LIMIT ?', (last_id, batch_size))]
+            if not product_ids:
+                return
+            variants = {product_id: [] for product_id in product_ids}
+            placeholders = ','.join('?' * len(product_ids))
+            for product_id, data in conn.execute(f'SELECT product_id, data FROM variants WHERE product_id IN ({placeholders}) ORDER BY product_id, position', product_ids):
+                variants[product_id].append(json_codec.loads(data))
+            for product_id in product_ids:
+                yield str(product_id), {str(product_id): variants[product_id]}
+            last_id = product_ids[-1]
+
+    def find_variants(self, sku: str = None, inventory_item_id: int = None) -> list:
+        if sku is not None:
+            rows = self.connection().execute('SELECT data FROM variants WHERE sku = ?', (sku,))
+        else:
+            rows = self.connection().execute('SELECT data FROM variants WHERE inventory_item_id = ?', (inventory_item_id,))
+        return [json_codec.loads(data) for data, in rows]
+
+    def variant_skus(self, product_id: int) -> list:
+        return [sku for sku, in self.connection().execute('SELECT sku FROM variants WHERE product_id = ? AND sku IS NOT NULL', (product_id,))]
+
+    def product_ids(self) -> set:
+        return {row[0] for row in self.connection().execute('SELECT id FROM products')}
+
+    # Sync status
+
+    def save_statuses(self, products: list):
+        self._write(self._save_statuses, products)
+
+    @staticmethod
+    def _save_statuses(conn: sqlite3.Connection, products: list):
+        synced_at = datetime.utcnow().isoformat()
+        rows = []
+        for productId, productJson in products:
+            for variant in productJson[productId]:
+                rows.append((variant['id'], int(productId), int(bool(variant.get('error'))), int(bool(variant.get('warning'))),
+                             variant.get('message'), synced_at))
+        conn.executemany('INSERT OR REPLACE INTO sync_status (variant_id, product_id, error, warning, message, synced_at) VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def count_synced_products(self) -> int:
+        return self.connection().execute('SELECT COUNT(DISTINCT product_id) FROM sync_status').fetchone()[0]
+
+    # Last quantity pushed to Shopify per inventory item
+
+    def get_pushed_levels(self) -> dict:
+        return {inventory_item_id: quantity for inventory_item_id, quantity in self.connection().execute('SELECT inventory_item_id, quantity FROM pushed_levels')}
+
+    def save_pushed_levels(self, levels: dict):
+        self._write(lambda conn: conn.executemany('INSERT OR REPLACE INTO pushed_levels (inventory_item_id, quantity) VALUES (?, ?)', levels.items()))
+
+    def clear_pushed_levels(self):
+        # Next diff_only sync reads and compares every variant again
+        self._write(lambda conn: conn.execute('DELETE FROM pushed_levels'))
+
+    # Key/value metadata
+
+    def get_meta(self, key: str, default=None):
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json_codec.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value):
+        self._write(lambda conn: conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json_codec.dumps(value))))
+
+    def import_product_files(self, path: str):
+        # One-off migration of the old data/products/<id>.json files
+        if self.files_checked:
+            return
+        self.files_checked = True
+        if not os.path.isdir(path) or self.get_meta('files_imported'):
+            return
+        batch = []
+        for file in os.listdir(path):
+            if file == 'count.json' or not file.endswith('.json'):
+                continue
+            try:
+                with open(f'{path}/{file}', "r") as f:
+                    productJson = json.load(f)
+            except ValueError:
+                logging.warning(f"Skipping unreadable product file {file}")
+                continue
+            for productId, variants in productJson.items():
+                batch.append({'id': int(productId), 'variants': variants})
+            if len(batch) >= STORE_BATCH_SIZE:
+                self.upsert_products(batch)
+                batch = []
+        if batch:
+            self.upsert_products(batch)
+        self.set_meta('files_imported', True)
+
+
+class BatchWriter():
+    # Buffers items from many threads and hands them to `flush_func` in batches
+
+    def __init__(self, flush_func, batch_size: int = STORE_BATCH_SIZE):
+        self.flush_func = flush_func
+        self.batch_size = batch_size
+        self.items = []
+        self.lock = threading.Lock()
+
+    def add(self, *item):
+        with self.lock:
+            self.items.append(item if len(item) > 1 else item[0])
+            if len(self.items) < self.batch_size:
+                return
+            items, self.items = self.items, []
+        self.flush_func(items)
+
+    def flush(self):
+        with self.lock:
+            items, self.items = self.items, []
+        if items:
+            self.flush_func(items)
@@ -0,0 +1,74 @@
+import time
+
+import json_codec
+
+# At most one progress event per this many seconds per stream, however often the job reports
+PROGRESS_STREAM_INTERVAL = 1.0
+# Comment line sent when nothing changed, keeps proxies from closing an idle stream
+PROGRESS_KEEPALIVE_INTERVAL = 15
+# Streams are closed after this long and EventSource reconnects. Each open stream holds a sync web worker,
+# so they stay short and other requests get served in between. Many open pages want a threaded worker class.
+PROGRESS_STREAM_MAX_AGE = 30
+# Milliseconds the browser waits before reconnecting
+PROGRESS_RETRY_MS = 3000
+
+FINISHED_STATUSES = ('done', 'failed', 'dead')
+
+# Counter pairs (done, total) each job kind reports
+PROGRESS_COUNTERS = {
+    'sync_products': ('processed', 'total'),
+    'load_products': ('loadedProducts', 'productsInTotal'),
+}
+
+
+def job_progress(job: dict, now: float = None) -> dict:
+    # Job progress plus throughput and ETA, derived from the counters only
+    now = now or time.time()
+    progress = job['progress'] or job['result'] or {}
+    done_key, total_key = PROGRESS_COUNTERS.get(job['kind'], ('processed', 'total'))
+    done = progress.get(done_key) or 0
+    total = progress.get(total_key)
+    started_at = job.get('started_at')
+    elapsed = ((job.get('finished_at') or now) - started_at) if started_at else 0.0
+    rate = done / elapsed if elapsed > 0 else None
+    eta = None
+    if rate and total is not None and job['status'] not in FINISHED_STATUSES:
+        eta = round(max(total - done, 0) / rate, 1)
+    return {'jobId': job['id'], 'kind': job['kind'], 'status': job['status'],
+            'done': done, 'total': total,
+            'percent': round(100.0 * done / total, 1) if total else None,
+            'elapsed': round(elapsed, 1), 'perSecond': round(rate, 2) if rate else None, 'eta': eta,
+            'progress': progress}
+
+
+def _event(name: str, data: dict) -> str:
+    return f"event: {name}\ndata: {json_codec.dumps(data)}\n\n"
+
+
+def progress_events(queue, job_id: str, interval: float = PROGRESS_STREAM_INTERVAL):
+    # text/event-stream body for one job. Only the job row is read, at most once per interval,
+    # and an event is only sent when something in it changed.
+    opened = last_sent = time.monotonic()
+    last_data = None
+    yield f"retry: {PROGRESS_RETRY_MS}\n\n"
+    while True:
+        job = queue.get(job_id)
+        if job is None:
+            yield _event('error', {'jobId': job_id, 'error': 'Unknown job'})
+            return
+        data = job_progress(job)
+        # elapsed/eta move on every read, only counter or status changes are worth an event
+        key = (data['status'], data['progress'])
+        if key != last_data:
+            last_data = key
+            last_sent = time.monotonic()
+            yield _event('progress', data)
+        elif time.monotonic() - last_sent >= PROGRESS_KEEPALIVE_INTERVAL:
+            last_sent = time.monotonic()
+            yield ": keepalive\n\n"
+        if job['status'] in FINISHED_STATUSES:
+            yield _event(job['status'], {'jobId': job_id, 'result': job['result'], 'error': job['error']})
+            return
+        if time.monotonic() - opened >= PROGRESS_STREAM_MAX_AGE:
+            return
+        time.sleep(interval)
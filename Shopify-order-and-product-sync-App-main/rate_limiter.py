@@ -0,0 +1,87 @@
+import time
+import threading
+
+# Shopify REST leaky bucket defaults, corrected from the call-limit header on every response
+# https://shopify.dev/concepts/about-apis/rate-limits
+SHOPIFY_BUCKET_SIZE = 40
+SHOPIFY_LEAK_RATE = 2.0  # requests per second
+SHOPIFY_CALL_LIMIT_HEADER = 'X-Shopify-Shop-Api-Call-Limit'
+
+
+class ShopifyRateLimiter():
+
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def __init__(self, capacity: int = SHOPIFY_BUCKET_SIZE, leak_rate: float = SHOPIFY_LEAK_RATE):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.used = 0.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_shop(cls, shop: str) -> 'ShopifyRateLimiter':
+        # Every client of the same shop draws from the same bucket
+        with cls._limiters_lock:
+            if shop not in cls._limiters:
+                cls._limiters[shop] = cls()
+            return cls._limiters[shop]
+
+    def _leak(self, now: float):
+        self.used = max(0.0, self.used - (now - self.updated) * self.leak_rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Reserve a slot in the bucket, returns how long the caller has to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self._leak(now)
+            self.used += 1
+            return max((self.used - self.capacity) / self.leak_rate, self.blocked_until - now, 0.0)
+
+    def acquire(self):
+        # Only sleeps if the reservation overflows the bucket
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, headers):
+        call_limit = headers.get(SHOPIFY_CALL_LIMIT_HEADER)
+        if not call_limit:
+            return
+        try:
+            used, capacity = (int(value) for value in call_limit.split('/'))
+        except ValueError:
+            return
+        with self.lock:
+            self._leak(time.monotonic())
+            self.capacity = capacity
+            # Other requests may still be in flight, never lower our own estimate below the shop's view
+            self.used = max(self.used, float(used))
+
+    def throttled(self, retry_after: float):
+        with self.lock:
+            now = time.monotonic()
+            self._leak(now)
+            self.used = float(self.capacity)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+
+    def usage(self) -> dict:
+        with self.lock:
+            self._leak(time.monotonic())
+            return {'used': round(self.used, 2), 'capacity': self.capacity}
+
+    @classmethod
+    def usage_by_shop(cls) -> dict:
+        with cls._limiters_lock:
+            limiters = dict(cls._limiters)
+        return {shop: limiter.usage() for shop, limiter in limiters.items()}
+
+
+def retry_after_seconds(headers, default: float = 1.0) -> float:
+    try:
+        return max(float(headers.get('Retry-After', default)), 0.0)
+    except (TypeError, ValueError):
+        return default
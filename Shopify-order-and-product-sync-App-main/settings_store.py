@@ -0,0 +1,86 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, fall back to in-process locking only
+    fcntl = None
+
+import json_codec
+
+
+class SettingsStore():
+    # settings.json kept parsed in memory, reloaded only when the file's mtime changes
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.settings = {}
+        self.mtime = None
+
+    @classmethod
+    def open(cls, path: str) -> 'SettingsStore':
+        with cls._stores_lock:
+            if path not in cls._stores:
+                cls._stores[path] = cls(path)
+            return cls._stores[path]
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            self.settings, self.mtime = {}, None
+            return
+        if mtime != self.mtime:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.settings = json_codec.loads(file.read())
+            self.mtime = mtime
+
+    def get(self) -> dict:
+        with self.lock:
+            self._refresh()
+            return dict(self.settings)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    @contextmanager
+    def transaction(self):
+        # Read-modify-write under both locks, several changes end up in a single write
+        with self.lock, self._file_lock():
+            self._refresh()
+            settings = dict(self.settings)
+            yield settings
+            if settings != self.settings:
+                self._write(settings)
+
+    def update(self, changes: dict = None, **kwargs) -> dict:
+        with self.transaction() as settings:
+            settings.update(changes or {}, **kwargs)
+        return dict(self.settings)
+
+    def _write(self, settings: dict):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(json_codec.dumps(settings))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self.settings = settings
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    @contextmanager
+    def _file_lock(self):
+        if not fcntl:
+            yield
+            return
+        with open(f"{self.path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
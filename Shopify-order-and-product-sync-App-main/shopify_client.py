@@ -1,52 +1,194 @@
 import random
 import pytz
 import os
-import math
-import json
+import time
 import logging
-from time import sleep as s
+import threading
 from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
 
 import requests
 from requests.exceptions import HTTPError
 
+import json_codec
+from http_session import get_session
+from cache import TTLCache
+from mypos_token import MYPOSTokenManager
+from rate_limiter import ShopifyRateLimiter, retry_after_seconds
+from product_store import ProductStore, BatchWriter, STORE_BATCH_SIZE
+from settings_store import SettingsStore
+from sync_engine import ConcurrentSync, PushedLevelsCache, SYNC_MYPOS_WORKERS, SYNC_SHOPIFY_WORKERS
 from config import SHOPIFY_SECRET, SHOPIFY_API_KEY, MYPOS_USER, MYPOS_PASS, MYPOS_SERVER, SERVER_HOST
 
 CURRENT_DIR = os.getcwd () + f"/{SERVER_HOST}"
+# Data of a client created without a shop registry entry, the layout from before shops were kept apart
+DATA_DIR = f"{CURRENT_DIR}/data"
 
 SHOPIFY_API_VERSION = "2020-10"
+# GraphQL calls go to a newer version, inventorySetQuantities with compareQuantity only exists from 2024-04 on
+SHOPIFY_GRAPHQL_API_VERSION = "2024-04"
+# Times a call rejected with 429 (or a GraphQL call answered THROTTLED) is retried before giving up
+SHOPIFY_MAX_RETRIES = 5
+# Seconds between full product id reconciliations when loading incrementally
+PRODUCTS_RECONCILE_INTERVAL = 24 * 60 * 60
+# Seconds between diff_only syncs that read every Shopify level again, so edits made in Shopify get corrected
+SYNC_FULL_COMPARE_INTERVAL = 24 * 60 * 60
+# inventory_levels.json accepts at most 50 inventory item ids per call
+SHOPIFY_INVENTORY_IDS_PER_CALL = 50
+# inventorySetQuantities takes at most 250 quantities per call
+SHOPIFY_INVENTORY_SET_PER_CALL = 250
+# Seconds between currentBulkOperation polls while a bulk export runs
+SHOPIFY_BULK_POLL_INTERVAL = 2
+# A bulk export still running after this many seconds is given up on
+SHOPIFY_BULK_TIMEOUT = 60 * 60
+
+# MYPOS store whose stock is mirrored to Shopify
+MYPOS_STOCK_NAME = "EARLY LEARNING CENTRE TEST"
+# Products per page when walking the whole MYPOS catalog
+MYPOS_PAGE_SIZE = 500
+# Concurrent MYPOS product lookups for a single order
+MYPOS_LOOKUP_WORKERS = 8
+# Fields of a MYPOS product that order processing needs, these are what the product cache keeps
+MYPOS_PRODUCT_METADATA_FIELDS = ('productId', 'longDescription', 'shortDescription')
+
+# Full catalog export, run as a bulk operation. Variants come back as separate JSONL rows carrying __parentId.
+PRODUCTS_BULK_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id
+        legacyResourceId
+        title
+        handle
+        vendor
+        productType
+        tags
+        createdAt
+        updatedAt
+        variants {
+          edges {
+            node {
+              id
+              legacyResourceId
+              sku
+              title
+              price
+              barcode
+              position
+              inventoryItem {
+                legacyResourceId
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+BULK_OPERATION_RUN_MUTATION = """
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+CURRENT_BULK_OPERATION_QUERY = """
+{
+  currentBulkOperation { id status errorCode objectCount url }
+}
+"""
+
+INVENTORY_SET_QUANTITIES_MUTATION = """
+mutation inventorySetQuantities($input: InventorySetQuantitiesInput!) {
+  inventorySetQuantities(input: $input) {
+    inventoryAdjustmentGroup { id }
+    userErrors { field message code }
+  }
+}
+"""
 
 REQUEST_METHODS = {
-    "GET": requests.get,
-    "POST": requests.post,
-    "PUT": requests.put,
-    "DEL": requests.delete
+    "GET": "GET",
+    "POST": "POST",
+    "PUT": "PUT",
+    "DEL": "DELETE"
 }
 
 #set the date and time format
 date_format = "%m-%d-%Y %H:%M:%S"
 
+def _parse_updated_at(value):
+    if not value:
+        return None
+    try:
+        # GraphQL timestamps end in Z, which fromisoformat only accepts from Python 3.11
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+
+def _graphql_throttle_wait(body: dict, headers) -> float:
+    # Seconds until the cost bucket holds enough for the query again, None when the call wasn't throttled
+    errors = body.get('errors')
+    if not isinstance(errors, list) or not any((error.get('extensions') or {}).get('code') == 'THROTTLED' for error in errors):
+        return None
+    try:
+        cost = body['extensions']['cost']
+        status = cost['throttleStatus']
+        return max(float(cost['requestedQueryCost']) - float(status['currentlyAvailable']), 0.0) / float(status['restoreRate'])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return retry_after_seconds(headers)
+
+def _legacy_id(gid: str) -> int:
+    # gid://shopify/Product/123 -> 123
+    return int(gid.rsplit('/', 1)[1])
+
+def _bulk_product(node: dict) -> dict:
+    # Bulk export row in the shape products.json returns, which is what the product store and sync expect
+    return {'id': int(node['legacyResourceId']), 'title': node.get('title'), 'handle': node.get('handle'),
+            'vendor': node.get('vendor'), 'product_type': node.get('productType'), 'tags': ', '.join(node.get('tags') or []),
+            'created_at': node.get('createdAt'), 'updated_at': node.get('updatedAt'), 'variants': []}
+
+def _bulk_variant(node: dict, product_id: int) -> dict:
+    inventory_item = node.get('inventoryItem') or {}
+    return {'id': int(node['legacyResourceId']), 'product_id': product_id, 'title': node.get('title'),
+            'sku': node.get('sku'), 'price': node.get('price'), 'barcode': node.get('barcode'), 'position': node.get('position'),
+            'inventory_item_id': int(inventory_item['legacyResourceId']) if inventory_item.get('legacyResourceId') else None}
+
 class ShopifyStoreClient():
 
-    def __init__(self, shop: str, access_token: str):
+    def __init__(self, shop: str, access_token: str, session: requests.Session = None, api_url: str = None, data_dir: str = DATA_DIR):
         self.shop = shop
-        self.base_url = f"https://{shop}/admin/api/{SHOPIFY_API_VERSION}/"
+        # Product store and settings of this shop live under data_dir
+        self.data_dir = data_dir
+        # api_url points the client somewhere else than the shop, e.g. mock_shopify.py
+        self.base_url = api_url or f"https://{shop}/admin/api/{SHOPIFY_API_VERSION}/"
+        self.graphql_url = self.base_url.replace(f"/{SHOPIFY_API_VERSION}/", f"/{SHOPIFY_GRAPHQL_API_VERSION}/") + "graphql.json"
         self.oauth_url = f"https://{shop}/admin/oauth/"
         self.access_token = access_token
+        self.session = session or get_session('shopify')
+        self.rate_limiter = ShopifyRateLimiter.for_shop(shop)
 
     @staticmethod
-    def authenticate(shop: str, code: str) -> str:
-        url = f"https://{shop}/admin/oauth/access_token"
+    def authenticate(shop: str, code: str, oauth_url: str = None) -> str:
+        # oauth_url points the token exchange somewhere else than the shop, e.g. mock_shopify.py
+        url = f"{oauth_url or f'https://{shop}/admin/oauth/'}access_token"
         payload = {
             "client_id": SHOPIFY_API_KEY,
             "client_secret": SHOPIFY_SECRET,
             "code": code
         }
         try:
-            response = requests.post(url, json=payload)
+            response = get_session('shopify').post(url, json=payload)
             response.raise_for_status()
-            return response.json()['access_token']
+            return json_codec.response_json(response)['access_token']
         except HTTPError as ex:
             logging.exception(ex)
             return None
@@ -55,50 +197,135 @@ class ShopifyStoreClient():
         call_path = "shop.json"
         url = f"{self.oauth_url}{call_path}"
         method = 'GET'
-        request_func = REQUEST_METHODS[method]
-        headers['X-Shopify-Access-Token'] = self.access_token
+        # Copied, the shared default dict would otherwise carry one shop's token into another shop's calls
+        headers = {**headers, 'X-Shopify-Access-Token': self.access_token}
         timezone_response = self.authenticated_shopify_call(call_path=call_path, method=method)
         if not timezone_response:
                 return None
         return timezone_response['shop']['iana_timezone']
 
+    def _shopify_request(self, url: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}):
+        for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+            self.rate_limiter.acquire()
+            response = self.session.request(REQUEST_METHODS[method], url, params=params, json=payload, headers=headers)
+            self.rate_limiter.update(response.headers)
+            if response.status_code != 429 or attempt == SHOPIFY_MAX_RETRIES:
+                return response
+            retry_after = retry_after_seconds(response.headers)
+            logging.warning(f"Shopify throttled {method} {url}, retrying in {retry_after}s")
+            self.rate_limiter.throttled(retry_after)
+
     def authenticated_shopify_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}) -> dict:
         url = f"{self.base_url}{call_path}"
-        request_func = REQUEST_METHODS[method]
-        headers['X-Shopify-Access-Token'] = self.access_token
+        headers = {**headers, 'X-Shopify-Access-Token': self.access_token}
         try:
-            response = request_func(url, params=params, json=payload, headers=headers)
+            response = self._shopify_request(url, method, params=params, payload=payload, headers=headers)
             response.raise_for_status()
-            logging.debug(f"authenticated_shopify_call response:\n{json.dumps(response.json(), indent=4)}")
-            return response.json()
+            body = json_codec.response_json(response)
+            json_codec.log_debug("authenticated_shopify_call response", body)
+            return body
         except HTTPError as ex:
             logging.exception(ex)
             return None
 
-    def response_shopify_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}) -> dict:
-        url = f"{self.base_url}{call_path}"
-        request_func = REQUEST_METHODS[method]
-        headers['X-Shopify-Access-Token'] = self.access_token
+    def response_shopify_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}, url: str = None) -> dict:
+        # url, when given, is an absolute URL on the shop (e.g. a page cursor) and replaces call_path
+        url = url or f"{self.base_url}{call_path}"
+        headers = {**headers, 'X-Shopify-Access-Token': self.access_token}
         try:
-            response = request_func(url, params=params, json=payload, headers=headers)
+            response = self._shopify_request(url, method, params=params, payload=payload, headers=headers)
             response.raise_for_status()
-            logging.debug(f"authenticated_shopify_call response:\n{json.dumps(response.json(), indent=4)}")
+            # Callers decode the body themselves, only decode it here as well when it gets logged
+            if json_codec.debug_enabled():
+                json_codec.log_debug("response_shopify_call response", json_codec.response_json(response))
             return response
         except HTTPError as ex:
             logging.exception(ex)
             return None
 
+    def iter_pages(self, call_path: str, key: str, params: dict = None):
+        # Yields one page of `key` at a time following rel="next" cursors, so memory stays flat
+        url = f"{self.base_url}{call_path}"
+        while url:
+            response = self.response_shopify_call(call_path=call_path, method='GET', params=params, url=url)
+            if response is None:
+                raise HTTPError(f"Shopify list call failed at {url}")
+            yield json_codec.response_json(response)[key]
+            next_link = response.links.get('next')
+            # The cursor URL already carries limit and fields, page_info can't be combined with other filters.
+            # It is followed as is, whatever form of the shop's host or API version it uses.
+            url = self._cursor_url(next_link['url']) if next_link else None
+            params = None
+
+    def _cursor_url(self, url: str) -> str:
+        # The access token goes along with the request, so never follow a cursor to another host
+        if urlsplit(url).netloc.lower() != urlsplit(self.base_url).netloc.lower():
+            raise HTTPError(f"Shopify page cursor points to another host: {url}")
+        return url
+
+    def iter_items(self, call_path: str, key: str, params: dict = None):
+        for page in self.iter_pages(call_path, key, params=params):
+            yield from page
+
+    def graphql(self, query: str, variables: dict = None) -> dict:
+        headers = {'X-Shopify-Access-Token': self.access_token}
+        for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+            response = self._shopify_request(self.graphql_url, 'POST', payload={'query': query, 'variables': variables or {}}, headers=headers)
+            response.raise_for_status()
+            body = json_codec.response_json(response)
+            if not body.get('errors'):
+                return body['data']
+            # Throttled queries come back as 200 and were not run, so they are safe to send again
+            retry_after = _graphql_throttle_wait(body, response.headers)
+            if retry_after is None or attempt == SHOPIFY_MAX_RETRIES:
+                raise HTTPError(f"Shopify GraphQL call failed: {body['errors']}")
+            # The cost bucket is separate from the REST call bucket, so only this call waits
+            logging.warning(f"Shopify throttled a GraphQL call, retrying in {retry_after:.1f}s")
+            time.sleep(retry_after)
+
+    def run_bulk_query(self, query: str, on_progress=None) -> str:
+        # Starts a bulk operation and waits for it, returns the URL of the JSONL result (None when nothing matched)
+        result = self.graphql(BULK_OPERATION_RUN_MUTATION, {'query': query})['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise HTTPError(f"Shopify bulk operation rejected: {result['userErrors']}")
+        operation_id = result['bulkOperation']['id']
+        deadline = time.monotonic() + SHOPIFY_BULK_TIMEOUT
+        while True:
+            operation = self.graphql(CURRENT_BULK_OPERATION_QUERY)['currentBulkOperation']
+            if not operation or operation['id'] != operation_id:
+                raise HTTPError(f"Shopify bulk operation {operation_id} was replaced by another one")
+            if on_progress:
+                on_progress(int(operation.get('objectCount') or 0))
+            if operation['status'] == 'COMPLETED':
+                return operation.get('url')
+            if operation['status'] in ('FAILED', 'CANCELED', 'EXPIRED'):
+                raise HTTPError(f"Shopify bulk operation {operation_id} {operation['status']}: {operation.get('errorCode')}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Shopify bulk operation {operation_id} still {operation['status']} after {SHOPIFY_BULK_TIMEOUT}s")
+            time.sleep(SHOPIFY_BULK_POLL_INTERVAL)
+
+    def iter_bulk_results(self, url: str):
+        # Streams the JSONL result line by line, the file is never held in memory
+        if not url:
+            return
+        # Signed storage URL, it must not get the shop's access token or the Shopify rate limiter
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json_codec.loads(line)
+
     def get_access_scopes(self,headers: dict = {}):
         call_path = "access_scopes.json"
         url = f"{self.oauth_url}{call_path}"
         method = 'GET'
-        request_func = REQUEST_METHODS[method]
-        headers['X-Shopify-Access-Token'] = self.access_token
+        headers = {**headers, 'X-Shopify-Access-Token': self.access_token}
         try:
-            access_scopes_response = request_func(url,headers=headers)
+            access_scopes_response = self.session.request(REQUEST_METHODS[method], url, headers=headers)
             access_scopes_response.raise_for_status()
-            logging.debug(f"get access scopes response:\n{json.dumps(access_scopes_response.json(), indent=4)}")
-            scopes = access_scopes_response.json()['access_scopes']
+            body = json_codec.response_json(access_scopes_response)
+            json_codec.log_debug("get access scopes response", body)
+            scopes = body['access_scopes']
             return [scope['handle'] for scope in scopes]
         except HTTPError as ex:
             logging.exception(ex)
@@ -138,6 +365,24 @@ class ShopifyStoreClient():
             return None
         return inventory_levels_response['inventory_levels']
 
+    def get_inventory_levels_batch(self, inventory_item_ids: list, location_ids: list = None, chunk_size: int = SHOPIFY_INVENTORY_IDS_PER_CALL) -> dict:
+        # Returns {inventory_item_id: [inventory levels]} using one call per chunk of ids
+        inventory_item_ids = list(dict.fromkeys(inventory_item_ids))
+        levels = {inventory_item_id: [] for inventory_item_id in inventory_item_ids}
+        for start in range(0, len(inventory_item_ids), chunk_size):
+            chunk = inventory_item_ids[start:start + chunk_size]
+            params = {'inventory_item_ids': ','.join(str(inventory_item_id) for inventory_item_id in chunk), 'limit': 250}
+            if location_ids:
+                params['location_ids'] = ','.join(str(location_id) for location_id in location_ids)
+            try:
+                # More locations than fit in one page are followed through the cursor
+                for inventory_level in self.iter_items('inventory_levels.json', 'inventory_levels', params=params):
+                    levels.setdefault(inventory_level['inventory_item_id'], []).append(inventory_level)
+            except HTTPError as ex:
+                logging.exception(ex)
+                return None
+        return levels
+
     def post_inventory_level(self, payload: dict = {}, params = None) -> dict:
         call_path = 'inventory_levels/set.json'
         method = 'POST'
@@ -149,108 +394,249 @@ class ShopifyStoreClient():
     def post_inventory_levels(self, payloads: list = [], params = None) -> dict:
         call_path = 'inventory_levels/set.json'
         method = 'POST'
-        print('Updating',len(payloads),'levels... Expecting',len(payloads),'sec to complete')
+        print('Updating',len(payloads),'levels...')
         for payload in payloads:
-            s(0.5)
             inventory_levels_response = self.authenticated_shopify_call(call_path=call_path, params=params, method=method, payload=payload)
             if not inventory_levels_response:
                 return None
         return len(payloads)
 
+    def set_inventory_levels_batch(self, levels: list, chunk_size: int = SHOPIFY_INVENTORY_SET_PER_CALL) -> dict:
+        # levels are inventory_levels.json entries with 'available' set to the new quantity and 'previous' holding the
+        # quantity just read from Shopify. Quantities are written as absolute values and Shopify only applies them while
+        # the level still holds 'previous', so an order placed in between is never overwritten and a resent call can't
+        # apply twice. Returns {inventory_item_id: error message} for the ones not written.
+        failures = {}
+        changed = []
+        for level in levels:
+            if level['previous'] is None:
+                # Shopify reports no quantity for items it doesn't track at the location, there is nothing to set
+                failures[level['inventory_item_id']] = "Inventory not tracked in Shopify"
+            elif int(level['available']) != int(level['previous']):
+                changed.append(level)
+        for start in range(0, len(changed), chunk_size):
+            failures.update(self._set_inventory_chunk(changed[start:start + chunk_size]))
+        return failures
+
+    def _set_inventory_chunk(self, chunk: list) -> dict:
+        failures = {}
+        while chunk:
+            variables = {'input': {'name': 'available', 'reason': 'correction',
+                                   'quantities': [{'inventoryItemId': f"gid://shopify/InventoryItem/{level['inventory_item_id']}",
+                                                   'locationId': f"gid://shopify/Location/{level['location_id']}",
+                                                   'quantity': int(level['available']), 'compareQuantity': int(level['previous'])}
+                                                  for level in chunk]}}
+            try:
+                result = self.graphql(INVENTORY_SET_QUANTITIES_MUTATION, variables)['inventorySetQuantities']
+            except requests.RequestException as ex:
+                logging.exception(ex)
+                failures.update({level['inventory_item_id']: "Inventory level update failed" for level in chunk})
+                return failures
+            errors = result.get('userErrors') or []
+            if not errors:
+                return failures
+            # userErrors point at the offending item through its index, e.g. ["input", "quantities", "3", "compareQuantity"]
+            blamed = {}
+            for error in errors:
+                field = error.get('field') or []
+                if len(field) > 2 and str(field[2]).isdigit() and int(field[2]) < len(chunk):
+                    if error.get('code') == 'COMPARE_QUANTITY_STALE':
+                        message = "Stock changed in Shopify during the sync, retried next run"
+                    else:
+                        message = error['message']
+                    blamed[int(field[2])] = message
+                else:
+                    logging.error(f"Inventory update failed: {error['message']}")
+            for index, message in blamed.items():
+                failures[chunk[index]['inventory_item_id']] = message
+            if result.get('inventoryAdjustmentGroup') is not None:
+                # The rest of the chunk went through
+                return failures
+            rest = [level for index, level in enumerate(chunk) if index not in blamed]
+            if len(rest) == len(chunk):
+                # Nothing applied and the errors can't be pinned on single items
+                failures.update({level['inventory_item_id']: "Inventory level update failed" for level in chunk})
+                return failures
+            # Nothing was applied, send the others again without the ones Shopify rejected
+            chunk = rest
+        return failures
+
+    @property
+    def settings(self) -> SettingsStore:
+        return SettingsStore.open(f"{self.data_dir}/settings/settings.json")
+
+    @property
+    def store(self) -> ProductStore:
+        store = ProductStore.open(f"{self.data_dir}/products.db")
+        store.import_product_files(f"{self.data_dir}/products")
+        return store
+
     def delete_product(self,product):
-        path = f"{CURRENT_DIR}/data/products/"
-        fileName = f"{product['id']}"
-        productFile = os.path.isfile(f"{path}{fileName}.json")
-        os.remove(f"{path}{fileName}.json")
+        self.store.delete_products([product['id']])
 
     def load_product(self,product):
-        variants = product['variants']
-        path = f"{CURRENT_DIR}/data/products/"
-        fileName = f"{product['id']}"
-        productFile = os.path.isfile(f"{path}{fileName}.json")
-        productJson = {product['id']:variants}
-
-        with open(f"{path}{fileName}.json","w") as file:
-            json.dump(productJson,file,indent=3)
+        # False when the store already holds a newer version of the product
+        return self.store.upsert_product_if_newer(product)
 
     def count_loaded_products(self):
-        path = f"{CURRENT_DIR}/data/products"
-        files = os.listdir(f'{path}')
-        return len(files)
+        return self.store.count_products()
 
     def count_synced_products(self):
-        path = f"{CURRENT_DIR}/data/status"
-        files = os.listdir(f'{path}')
-        return len(files)
+        return self.store.count_synced_products()
 
-    def load_all_products(self,pageSize=250):
+    def load_all_products(self,pageSize=250,incremental=False,on_progress=None):
         #timezone = self.get_timezone()
-
-        Previous = ' rel="previous"'
-        Next = ' rel="next"'
-
-        productsTotal = self.get_products_count()
-        pagesTotal = math.ceil(productsTotal/pageSize)
-        call_path = 'products.json'
-
-        for i in range(pagesTotal):
-            s(0.5)
-            response = self.response_shopify_call(call_path=call_path,method='GET',params={'limit':pageSize})
-            print(response.headers)
-            if 'Link' in response.headers:
-                linkHeaders = response.headers['Link']
-                pageLinks = linkHeaders.replace(';',',').replace('<','').replace('>','').split(',')
-            else:
-                break
-
-            products = response.json()['products']
-
+        store = self.store
+        updated_at_min = store.get_meta('products_updated_at') if incremental else None
+        last_full_load = store.get_meta('products_reconciled_at')
+        full = not updated_at_min
+        reconcile = full or not last_full_load or time.time() - last_full_load > PRODUCTS_RECONCILE_INTERVAL
+
+        params = {'limit':pageSize}
+        if not full:
+            params['updated_at_min'] = updated_at_min
+        high_water = _parse_updated_at(updated_at_min)
+        seen = set()
+        loaded = 0
+        for products in self.iter_pages('products.json','products',params=params):
+            store.upsert_products(products)
+            loaded += len(products)
+            if on_progress:
+                on_progress(loaded)
             for product in products:
-                self.load_product(product)
-
-            if Next in pageLinks:
-                NextPage = pageLinks[pageLinks.index(Next)-1]
-                cutPosition = NextPage.find('products.json')
-                call_path = NextPage[cutPosition:]
+                if full:
+                    seen.add(product['id'])
+                updated_at = _parse_updated_at(product.get('updated_at'))
+                if updated_at and (not high_water or updated_at > high_water):
+                    high_water = updated_at
+
+        if reconcile:
+            # Deleted products never show up in an updated_at_min query, so compare the full id list now and then
+            if not full:
+                for products in self.iter_pages('products.json','products',params={'limit':pageSize,'fields':'id'}):
+                    seen.update(product['id'] for product in products)
+            deleted = store.product_ids() - seen
+            if deleted:
+                store.delete_products(list(deleted))
+            store.set_meta('products_reconciled_at',time.time())
+            print('Reconciled products,',len(deleted),'deleted')
+        if high_water:
+            store.set_meta('products_updated_at',high_water.isoformat())
+        print('Loaded',loaded,'products','(full)' if full else f'(changed since {updated_at_min})')
+
+        self.settings.update(firstLoad=True,loadActive=False)
+        return loaded
+
+    def load_all_products_bulk(self,batchSize=STORE_BATCH_SIZE,on_progress=None):
+        # Full load through one bulk operation instead of a REST call per 250 products
+        store = self.store
+        url = self.run_bulk_query(PRODUCTS_BULK_QUERY)
+        # Children follow their parent in the export, so only the last few products are kept until they're written
+        pending = OrderedDict()
+        seen = set()
+        high_water = None
+        loaded = 0
+
+        def write(count):
+            nonlocal loaded
+            batch = [pending.popitem(last=False)[1] for _ in range(min(count, len(pending)))]
+            store.upsert_products(batch)
+            loaded += len(batch)
+            if on_progress:
+                on_progress(loaded)
+
+        for row in self.iter_bulk_results(url):
+            parent = row.get('__parentId')
+            if parent is None:
+                product = _bulk_product(row)
+                pending[row['id']] = product
+                seen.add(product['id'])
+                updated_at = _parse_updated_at(product['updated_at'])
+                if updated_at and (not high_water or updated_at > high_water):
+                    high_water = updated_at
+                if len(pending) >= 2 * batchSize:
+                    write(batchSize)
+            elif parent in pending:
+                pending[parent]['variants'].append(_bulk_variant(row, pending[parent]['id']))
             else:
-                NextPage = ''
-                break
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"r") as file:
-            settings = json.load(file)
-
-        settings['firstLoad'] = True
-        settings['loadActive'] = False
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"w") as file:
-            json.dump(settings,file,indent=3)
-
-    def sync_products(self,mypos_client):
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"r") as file:
-            settings = json.load(file)
-
-        settings['syncActive'] = True
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"w") as file:
-            json.dump(settings,file,indent=3)
-
-        load_path = f"{CURRENT_DIR}/data/products"
-        save_path = f"{CURRENT_DIR}/data/status"
-
-        files = os.listdir(f'{load_path}.')
-        for file in files:
-            with open(f'{load_path}/{file}',"r") as f:
-                productJson = json.load(f)
-                productId = file.replace('.json','')
+                # Product already written, add the straggler on its own
+                store.append_variants(_legacy_id(parent), [_bulk_variant(row, _legacy_id(parent))])
+        while pending:
+            write(batchSize)
+
+        deleted = store.product_ids() - seen
+        if deleted:
+            store.delete_products(list(deleted))
+        store.set_meta('products_reconciled_at',time.time())
+        if high_water:
+            store.set_meta('products_updated_at',high_water.isoformat())
+        print('Loaded',loaded,'products (bulk),',len(deleted),'deleted')
+
+        self.settings.update(firstLoad=True,loadActive=False)
+        return loaded
+
+    def iter_loaded_products(self):
+        return self.store.iter_products()
+
+    def sync_products(self,mypos_client,concurrent=False,snapshot=False,diff_only=False,mypos_workers=SYNC_MYPOS_WORKERS,shopify_workers=SYNC_SHOPIFY_WORKERS,on_progress=None):
+        self.settings.update(syncActive=True)
+
+        if snapshot:
+            # Resolve stock from one pass over the MYPOS catalog instead of a call per variant
+            try:
+                mypos_client = MYPOSStockSnapshot(mypos_client).load()
+            except Exception:
+                self._finish_sync()
+                raise
+
+        if concurrent:
+            full_compare = False
+            if diff_only:
+                # Skipped variants are never read from Shopify, so drift there (manual edits, failed sales) would stick.
+                # Now and then the last pushed levels are forgotten and every level is compared again.
+                last_full_compare = self.store.get_meta('levels_compared_at')
+                full_compare = not last_full_compare or time.time() - last_full_compare > SYNC_FULL_COMPARE_INTERVAL
+                if full_compare:
+                    self.store.clear_pushed_levels()
+            pushed_cache = PushedLevelsCache(self.store) if diff_only else None
+            engine = ConcurrentSync(self, mypos_client, mypos_workers=mypos_workers, shopify_workers=shopify_workers, pushed_cache=pushed_cache)
+            status_writer = BatchWriter(self.store.save_statuses)
+            try:
+                engine.run(self.iter_loaded_products(), on_product_done=status_writer.add, on_progress=on_progress,
+                           total=self.count_loaded_products())
+            finally:
+                status_writer.flush()
+                self._finish_sync()
+            if full_compare:
+                self.store.set_meta('levels_compared_at', time.time())
+            return "OK"
+
+        status_writer = BatchWriter(self.store.save_statuses)
+        try:
+            for productId, productJson in self.iter_loaded_products():
                 variants = productJson[productId]
+                # None when a lookup chunk failed, every variant of the product is then reported instead of aborting the run
+                levels = self.get_inventory_levels_batch([variant['inventory_item_id'] for variant in variants if variant['sku']])
+                changed = []
                 for variant in variants:
-                    s(0.5)
                     if variant['sku']:
                         quantity = mypos_client.get_stock(productCode=variant['sku'])
                         print("quantity:",quantity)
                         if type(quantity) == int or type(quantity) == float:
-                            params = {'inventory_item_ids':variant['inventory_item_id']}
-                            inventory_levels = self.get_inventory_levels(params=params)
+                            inventory_levels = None if levels is None else levels.get(variant['inventory_item_id'])
+                            if levels is None:
+                                variant['error'] = True
+                                variant['warning'] = False
+                                variant['message'] = "Inventory level lookup failed"
+                                continue
+                            if not inventory_levels:
+                                variant['error'] = True
+                                variant['warning'] = False
+                                variant['message'] = "Inventory level not found in Shopify"
+                                continue
                             inventory_level = inventory_levels[0]
-                            inventory_level['available'] = int(quantity)
-                            self.post_inventory_level(payload = inventory_level)
+                            if inventory_level['available'] != int(quantity):
+                                changed.append(dict(inventory_level, available=int(quantity), previous=inventory_level['available']))
                             variant['error'] = False
                             variant['warning'] = False
                             variant['message'] = "Synced"
@@ -261,19 +647,27 @@ class ShopifyStoreClient():
                     else:
                         variant['error'] = False
                         variant['warning'] = True
-                        variant['messsage'] = "SKU is not defined"
-
-                with open(f'{save_path}/{file}',"w") as file:
-                    json.dump(productJson,file,indent=3)
-
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"r") as file:
-            settings = json.load(file)
+                        variant['message'] = "SKU is not defined"
+                try:
+                    failures = self.set_inventory_levels_batch(changed) if changed else {}
+                except Exception as ex:
+                    # One product's write failing must not end the run
+                    logging.exception(ex)
+                    failures = {level['inventory_item_id']: "Inventory level update failed" for level in changed}
+                for variant in variants:
+                    if variant['inventory_item_id'] in failures:
+                        variant['error'] = True
+                        variant['message'] = failures[variant['inventory_item_id']]
+
+                status_writer.add(productId,productJson)
+        finally:
+            status_writer.flush()
+            self._finish_sync()
+        return "OK"
 
-        settings['syncActive'] = False
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"w") as file:
-            json.dump(settings,file,indent=3)
+    def _finish_sync(self):
+        self.settings.update(syncActive=False)
 
-        return "OK"
     def get_products_count(self):
         call_path = f'products/count.json'
         method = 'GET'
@@ -290,6 +684,9 @@ class ShopifyStoreClient():
             return None
         return products_response['products']
 
+    def iter_products(self,params = None):
+        return self.iter_items('products.json', 'products', params=params)
+
     def get_smart_collections(self,params = None) -> dict:
         call_path = 'smart_collections.json'
         method = 'GET'
@@ -298,6 +695,9 @@ class ShopifyStoreClient():
             return None
         return smart_collections_response['smart_collections']
 
+    def iter_smart_collections(self,params = None):
+        return self.iter_items('smart_collections.json', 'smart_collections', params=params)
+
     def get_product(self,product_id,params = None) -> dict:
         call_path = f'products/{product_id}.json'
         method = 'GET'
@@ -331,6 +731,9 @@ class ShopifyStoreClient():
             return None
         return script_tags_response['script_tags']
 
+    def iter_script_tags(self, params: dict = None):
+        return self.iter_items('script_tags.json', 'script_tags', params=params)
+
     def get_script_tag(self, id: int) -> dict:
         call_path = f'script_tags/{id}.json'
         method = 'GET'
@@ -429,46 +832,78 @@ class ShopifyStoreClient():
 
 class MYPOSConnectClient():
 
-    def __init__(self, access_token: str):
-        self.base_url = f"https://{MYPOS_SERVER}"
-        self.access_token = access_token
+    def __init__(self, access_token: str = None, session: requests.Session = None, token_manager: MYPOSTokenManager = None, product_cache: TTLCache = None, api_url: str = None):
+        # api_url points the client somewhere else than MYPOS_SERVER, e.g. mock_mypos.py
+        self.base_url = api_url or f"https://{MYPOS_SERVER}"
+        self._access_token = access_token
+        self.token_manager = token_manager
+        self.product_cache = product_cache
+        self.session = session or get_session('mypos')
+
+    @classmethod
+    def shared(cls, token_path: str, product_cache: TTLCache = None) -> 'MYPOSConnectClient':
+        # Client backed by the process-wide token manager for `token_path`
+        return cls(token_manager=MYPOSTokenManager.shared(token_path, cls.authenticate), product_cache=product_cache)
+
+    @property
+    def access_token(self) -> str:
+        if self.token_manager:
+            return self.token_manager.get_token()
+        return self._access_token
+
+    def _mypos_request(self, http_method: str, url: str, params: dict = None, payload: dict = None, headers: dict = {}):
+        # Retries once with a fresh token when MYPOS rejects an expired one
+        for attempt in range(2):
+            token = self.access_token
+            request_headers = dict(headers)
+            request_headers['Authorization'] = 'Bearer ' + token
+            response = self.session.request(http_method, url, params=params, json=payload, headers=request_headers)
+            if response.status_code != 401 or not self.token_manager or attempt:
+                return response
+            logging.warning(f"MYPOS rejected the bearer token for {url}, re-authenticating")
+            self.token_manager.invalidate(token)
 
     @staticmethod
     def authenticate():
         url = f"https://{MYPOS_USER}:{MYPOS_PASS}@{MYPOS_SERVER}auth/token"
         try:
-            response = requests.post(url)
+            response = get_session('mypos').post(url)
             response.raise_for_status()
-            return response.json()['bearerToken']
+            return json_codec.response_json(response)['bearerToken']
         except HTTPError as ex:
             logging.exception(ex)
             return None
 
-    def authenticated_mypos_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}) -> dict:
+    def authenticated_mypos_call(self, call_path: str, method: str, params: dict = None, payload: dict = None, headers: dict = {}, raise_server_errors: bool = False) -> dict:
+        # Rejected calls are logged and return None. With raise_server_errors a 5xx is raised instead, so a caller
+        # that retries later (order jobs) can tell MYPOS being down from MYPOS refusing the data.
         url = f"{self.base_url}{call_path}"
-        request_func = REQUEST_METHODS[method]
-        headers['Authorization'] =  'Bearer ' + self.access_token
+        http_method = REQUEST_METHODS[method]
         if call_path == "saleitems":
             try:
-                response = request_func(url, params=params, json=payload, headers=headers)
+                response = self._mypos_request(http_method, url, params=params, payload=payload, headers=headers)
                 print('Response Body: ',response.content)
                 response.raise_for_status()
-                #logging.debug(f"authenticated_mypos_call response:\n{json.dumps(response.json(), indent=4)}")
                 if response.status_code == 200 or response.status_code == 202:
                     return payload["items"][0]['receiptId']
                 else:
                     return None
             except HTTPError as ex:
                 logging.exception(ex)
+                if raise_server_errors and ex.response is not None and ex.response.status_code >= 500:
+                    raise
                 return None
         else:
             try:
-                response = request_func(url, params=params, json=payload, headers=headers)
+                response = self._mypos_request(http_method, url, params=params, payload=payload, headers=headers)
                 response.raise_for_status()
-                logging.debug(f"authenticated_mypos_call response:\n{json.dumps(response.json(), indent=4)}")
-                return response.json()
+                body = json_codec.response_json(response)
+                json_codec.log_debug("authenticated_mypos_call response", body)
+                return body
             except HTTPError as ex:
                 logging.exception(ex)
+                if raise_server_errors and ex.response is not None and ex.response.status_code >= 500:
+                    raise
                 return None
 
 
@@ -480,6 +915,41 @@ class MYPOSConnectClient():
             return None
         return product_response
 
+    def get_product_metadata(self, productCode) -> dict:
+        # Descriptions and id of a product, served from product_cache when one is attached
+        if self.product_cache:
+            metadata = self.product_cache.get(productCode)
+            if metadata is not None:
+                return metadata
+        return self._fetch_product_metadata(productCode)
+
+    def _fetch_product_metadata(self, productCode) -> dict:
+        product = self.get_product(productCode=productCode)
+        if not product:
+            return None
+        metadata = {field: product.get(field) for field in MYPOS_PRODUCT_METADATA_FIELDS}
+        if self.product_cache:
+            self.product_cache.set(productCode, metadata)
+        return metadata
+
+    def get_products_by_code(self, productCodes: list, max_workers: int = MYPOS_LOOKUP_WORKERS, metadata_only: bool = False) -> dict:
+        # {productCode: product or None}, each distinct code is fetched once with bounded concurrency
+        productCodes = list(dict.fromkeys(productCodes))
+        if not productCodes:
+            return {}
+        if metadata_only and self.product_cache:
+            # Cached codes never reach the thread pool
+            products = {productCode: self.product_cache.get(productCode) for productCode in productCodes}
+            productCodes = [productCode for productCode, product in products.items() if product is None]
+            if not productCodes:
+                return products
+        else:
+            products = {}
+        fetch = self._fetch_product_metadata if metadata_only else (lambda productCode: self.get_product(productCode=productCode))
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(productCodes)), thread_name_prefix='mypos-lookup') as executor:
+            products.update(zip(productCodes, executor.map(fetch, productCodes)))
+        return products
+
     def get_products(self, params: dict = None) -> dict:
         call_path = f'products'
         method = 'GET'
@@ -488,15 +958,33 @@ class MYPOSConnectClient():
             return None
         return products_response
 
+    def iter_all_products(self, page_size: int = MYPOS_PAGE_SIZE):
+        page = 1
+        first_code = None
+        while True:
+            products_response = self.get_products(params={'pageNumber': page, 'pageSize': page_size})
+            if isinstance(products_response, dict):
+                products_response = products_response.get('products')
+            if not products_response:
+                return
+            # Stop if the server ignores paging and keeps sending the first page back
+            if page > 1 and products_response[0].get('productCode') == first_code:
+                return
+            first_code = first_code or products_response[0].get('productCode')
+            for product in products_response:
+                yield product
+            if len(products_response) < page_size:
+                return
+            page += 1
+
     def get_stock(self, productCode, params: dict = None, payload: dict = None, headers={}) -> dict:
         product_response = {}
-        stock_name ="EARLY LEARNING CENTRE TEST"
+        stock_name = MYPOS_STOCK_NAME
         call_path = f"products/{productCode}"
         url = f"{self.base_url}{call_path}"
-        headers['Authorization'] =  'Bearer ' + self.access_token
-        response = requests.get(url, headers=headers)
+        response = self._mypos_request('GET', url, headers=headers)
         if response.status_code == 200 or response.status_code == 202:
-            product_response = response.json()
+            product_response = json_codec.response_json(response)
         if not product_response:
             return None
         if product_response['storeStocks']:
@@ -526,7 +1014,7 @@ class MYPOSConnectClient():
     def create_saleitem(self, params: dict = None, payload: dict = None) -> dict:
         call_path = 'saleitems'
         method = 'POST'
-        saleitem_response = self.authenticated_mypos_call(call_path=call_path, method=method, params=params, payload=payload)
+        saleitem_response = self.authenticated_mypos_call(call_path=call_path, method=method, params=params, payload=payload, raise_server_errors=True)
         if not saleitem_response:
             return None
         return saleitem_response
@@ -534,7 +1022,7 @@ class MYPOSConnectClient():
     def create_customer(self, params: dict = None, payload: dict = None) -> dict:
         call_path = 'customers'
         method = 'POST'
-        customer_response = self.authenticated_mypos_call(call_path=call_path, method=method, params=params, payload=payload)
+        customer_response = self.authenticated_mypos_call(call_path=call_path, method=method, params=params, payload=payload, raise_server_errors=True)
         if not customer_response:
             return None
         return customer_response
@@ -547,3 +1035,55 @@ class MYPOSConnectClient():
             return None
         return product_response['products']
 
+
+class MYPOSStockSnapshot():
+
+    def __init__(self, mypos_client: MYPOSConnectClient, stock_name: str = MYPOS_STOCK_NAME):
+        self.mypos_client = mypos_client
+        self.stock_name = stock_name
+        self.index = {}
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.fallback_calls = 0
+
+    def load(self, page_size: int = MYPOS_PAGE_SIZE) -> 'MYPOSStockSnapshot':
+        index = {}
+        for product in self.mypos_client.iter_all_products(page_size=page_size):
+            productCode = product.get('productCode')
+            if not productCode:
+                continue
+            index[productCode] = {stock['name']: stock['quantity'] for stock in product.get('storeStocks') or []}
+        with self.lock:
+            self.index.update(index)
+        print('MYPOS snapshot loaded',len(index),'products')
+        return self
+
+    def get_stock(self, productCode, **kwargs):
+        # Same contract as MYPOSConnectClient.get_stock, served from the index.
+        # SKUs missing from the snapshot are fetched once and remembered, concurrent callers wait on that fetch.
+        with self.lock:
+            if productCode in self.index:
+                return self._quantity(productCode)
+            event = self.inflight.get(productCode)
+            owner = event is None
+            if owner:
+                event = self.inflight[productCode] = threading.Event()
+                self.fallback_calls += 1
+        if not owner:
+            event.wait()
+            with self.lock:
+                return self._quantity(productCode)
+        quantity = None
+        try:
+            quantity = self.mypos_client.get_stock(productCode=productCode)
+        finally:
+            with self.lock:
+                stocks = self.index.setdefault(productCode, {})
+                if quantity is not None:
+                    stocks[self.stock_name] = quantity
+                del self.inflight[productCode]
+            event.set()
+        return quantity
+
+    def _quantity(self, productCode):
+        return self.index.get(productCode, {}).get(self.stock_name)
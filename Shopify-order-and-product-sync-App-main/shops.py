@@ -0,0 +1,145 @@
+import os
+import time
+import uuid
+import logging
+import threading
+
+from settings_store import SettingsStore
+from shopify_client import ShopifyStoreClient, CURRENT_DIR, DATA_DIR
+
+try:
+    from config import LEGACY_SHOP
+except ImportError:  # Optional, the shop a single-shop install served before several were supported
+    LEGACY_SHOP = None
+
+# Installed shops: {shop: {access_token, data_dir, installed_at, nonce, nonce_at}}
+SHOPS_FILE = f"{CURRENT_DIR}/data/shops.json"
+# Every shop gets its own product store and settings under here
+SHOPS_DIR = f"{CURRENT_DIR}/data/shops"
+# Where the app kept its one shop's token before it served several
+LEGACY_TOKEN_FILE = f"{CURRENT_DIR}/shopify_token.txt"
+# Seconds an install nonce stays valid
+SHOP_NONCE_TTL = 60 * 60
+
+DEFAULT_SETTINGS = {'turnSyncOn': False, 'syncActive': False, 'loadActive': False, 'firstSync': False, 'firstLoad': False}
+
+
+def normalize_shop(shop: str) -> str:
+    return shop.strip().rstrip('/').lower()
+
+
+class ShopRegistry():
+    # Tokens, data directories and long-lived API clients per shop
+
+    _registries = {}
+    _registries_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        # SettingsStore gives the index the same mtime caching and atomic, locked writes as settings.json
+        self.index = SettingsStore.open(path)
+        self.clients = {}
+        # Points every shop's client somewhere else than the shop, e.g. mock_shopify.py
+        self.api_url = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: str) -> 'ShopRegistry':
+        with cls._registries_lock:
+            if path not in cls._registries:
+                cls._registries[path] = cls(path)
+            return cls._registries[path]
+
+    def get(self, shop: str) -> dict:
+        shop = normalize_shop(shop)
+        entry = self.index.get().get(shop)
+        if entry is None and LEGACY_SHOP and shop == normalize_shop(LEGACY_SHOP):
+            return self.adopt_legacy(shop)
+        return dict(entry) if entry is not None else None
+
+    def adopt_legacy(self, shop: str) -> dict:
+        # A single-shop install keeps working: shopify_token.txt and data/ go to config.LEGACY_SHOP, or without one
+        # to the first shop whose app launch passed the HMAC check. Never to a shop that is already registered.
+        shop = normalize_shop(shop)
+        entry = self.index.get().get(shop)
+        if entry is not None:
+            return dict(entry)
+        if LEGACY_SHOP and shop != normalize_shop(LEGACY_SHOP):
+            return None
+        try:
+            with open(LEGACY_TOKEN_FILE, "r") as token_file:
+                token = token_file.read().strip()
+        except FileNotFoundError:
+            return None
+        if not token:
+            return None
+        adopted = False
+        with self.index.transaction() as shops:
+            if shop not in shops and not any(entry.get('data_dir') == DATA_DIR for entry in shops.values()):
+                shops[shop] = {'access_token': token, 'data_dir': DATA_DIR, 'installed_at': time.time()}
+                adopted = True
+            entry = shops.get(shop)
+        if adopted:
+            logging.warning(f"Shop {shop} adopted the legacy {LEGACY_TOKEN_FILE} and {DATA_DIR}")
+        return dict(entry) if entry else None
+
+    def _new_entry(self, shop: str) -> dict:
+        return {'access_token': '', 'data_dir': f"{SHOPS_DIR}/{shop}", 'installed_at': time.time()}
+
+    def token(self, shop: str) -> str:
+        entry = self.get(shop)
+        return entry.get('access_token') if entry else None
+
+    def set_token(self, shop: str, access_token: str):
+        # An empty token marks the shop uninstalled, its data stays for a reinstall
+        shop = normalize_shop(shop)
+        with self.index.transaction() as shops:
+            # Entries are replaced, never mutated, so the transaction sees the change
+            entry = dict(shops.get(shop) or self._new_entry(shop), access_token=access_token)
+            shops[shop] = entry
+        with self.lock:
+            self.clients.pop(shop, None)
+        if access_token:
+            self._prepare_data_dir(entry['data_dir'])
+
+    @staticmethod
+    def _prepare_data_dir(data_dir: str):
+        os.makedirs(f"{data_dir}/settings", exist_ok=True)
+        settings = SettingsStore.open(f"{data_dir}/settings/settings.json")
+        with settings.transaction() as current:
+            for key, value in DEFAULT_SETTINGS.items():
+                current.setdefault(key, value)
+
+    def shops(self) -> list:
+        # Installed shops only
+        return [shop for shop, entry in self.index.get().items() if entry.get('access_token')]
+
+    def client(self, shop: str) -> ShopifyStoreClient:
+        # Clients are kept for the life of the process and only rebuilt when the shop's token changes
+        shop = normalize_shop(shop)
+        entry = self.get(shop)
+        if not entry or not entry.get('access_token'):
+            raise RuntimeError(f"Shop {shop} is not installed")
+        with self.lock:
+            client = self.clients.get(shop)
+            if client is None or client.access_token != entry['access_token']:
+                client = ShopifyStoreClient(shop=shop, access_token=entry['access_token'], api_url=self.api_url, data_dir=entry['data_dir'])
+                self.clients[shop] = client
+            return client
+
+    # Install nonces, kept in the index so the OAuth callback may land on any web worker
+
+    def new_nonce(self, shop: str) -> str:
+        shop = normalize_shop(shop)
+        nonce = uuid.uuid4().hex
+        with self.index.transaction() as shops:
+            shops[shop] = dict(shops.get(shop) or self._new_entry(shop), nonce=nonce, nonce_at=time.time())
+        return nonce
+
+    def consume_nonce(self, shop: str, state: str) -> bool:
+        shop = normalize_shop(shop)
+        with self.index.transaction() as shops:
+            entry = shops.get(shop)
+            if not entry or not state or entry.get('nonce') != state or time.time() - entry.get('nonce_at', 0) > SHOP_NONCE_TTL:
+                return False
+            shops[shop] = {key: value for key, value in entry.items() if key not in ('nonce', 'nonce_at')}
+        return True
@@ -1,29 +1,18 @@
 import json
-import os
-from shopify_client import ShopifyStoreClient, MYPOSConnectClient
-from config import SERVER_HOST
-shop = "teststore.myshopify.com/"
-TOKEN_FILE = "shopify_token.txt"
+import tasks
+from shops import LEGACY_SHOP
 
-CURRENT_DIR = os.getcwd () + f"/{SERVER_HOST}"
-bearerToken = MYPOSConnectClient.authenticate()
-mypos_client = MYPOSConnectClient(bearerToken)
+# Run periodically: queues a sync for every installed shop that has syncing turned on.
+# A single-shop install that was never registered is picked up under config.LEGACY_SHOP, when set.
 
-with open(f'{CURRENT_DIR}/{TOKEN_FILE}',"r") as token_file:
-    ACCESS_TOKEN = token_file.read()
 
-if ACCESS_TOKEN:
+def app_getSettings(shopify_client):
+    return json.dumps(shopify_client.settings.get())
 
-    def app_getSettings():
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"r") as file:
-            settings = json.load(file)
-        return json.dumps(settings)
-
-    def app_changeSettings(params = {}):
-        if params:
-            data = params
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"r") as file:
-            settings = json.load(file)
+def app_changeSettings(shopify_client, params = {}):
+    if params:
+        data = params
+    with shopify_client.settings.transaction() as settings:
         if 'syncActive' in data:
             settings['syncActive'] = json.loads(data['syncActive'])
         if 'loadActive' in data:
@@ -32,21 +21,21 @@ if ACCESS_TOKEN:
             settings['firstSync'] = json.loads(data['firstSync'])
         if 'firstLoad' in data:
             settings['firstLoad'] = json.loads(data['firstLoad'])
-
-        with open(f'{CURRENT_DIR}/data/settings/settings.json',"w") as file:
-            json.dump(settings,file,indent=3)
-        return json.dumps(settings)
-
-
-
-
-
-    shopify_client = ShopifyStoreClient(shop=shop, access_token=ACCESS_TOKEN)
-    settings = json.loads(app_getSettings())
-    if settings['syncActive']:
-        syncedProducts = shopify_client.count_synced_products()
-        productsInTotal = shopify_client.get_products_count()
-        syncStatus = {'syncedProducts':syncedProducts,'productsInTotal':productsInTotal}
-        print (json.dumps(syncStatus))
-    elif settings['turnSyncOn'] :
-        shopify_client.sync_products(mypos_client)
+    return json.dumps(settings)
+
+
+registry = tasks.shops()
+if LEGACY_SHOP:
+    # Claims shopify_token.txt and data/ for the configured shop if it hasn't taken them over yet
+    registry.get(LEGACY_SHOP)
+
+for shop in registry.shops():
+    shopify_client = tasks.shop_client(shop)
+    settings = json.loads(app_getSettings(shopify_client))
+    job = tasks.job_queue().active('sync_products', {'shop':shop})
+    if job:
+        print (json.dumps(tasks.sync_status(job, shopify_client.store)))
+    elif settings.get('turnSyncOn'):
+        # The sync itself runs on the job workers (worker.py or the web app's in-process workers), one job per shop
+        job = tasks.enqueue_unique('sync_products', {'shop':shop})
+        print ('Queued sync job', job['id'], 'for', shop)
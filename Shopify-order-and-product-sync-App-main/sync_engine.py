@@ -0,0 +1,283 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# Parallelism per upstream. MYPOS only serves stock reads, Shopify does the
+# inventory level read and the write for every variant.
+SYNC_MYPOS_WORKERS = 8
+SYNC_SHOPIFY_WORKERS = 4
+# Upper bound on variants in flight between the two stages
+SYNC_MAX_PENDING = 200
+# Variants whose inventory levels are read with a single Shopify call
+SYNC_BATCH_SIZE = 50
+# Seconds between throughput reports in the log
+SYNC_REPORT_INTERVAL = 10
+# Seconds between progress updates handed to on_progress (the job record polled by the UI)
+SYNC_PROGRESS_INTERVAL = 2
+
+
+class PushedLevelsCache():
+    # Last quantity written to Shopify per inventory item, persisted in the product store between runs
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.levels = store.get_pushed_levels()
+        self.changed = {}
+
+    def get(self, inventory_item_id):
+        with self.lock:
+            return self.levels.get(inventory_item_id)
+
+    def set(self, inventory_item_id, quantity: int):
+        with self.lock:
+            if self.levels.get(inventory_item_id) != quantity:
+                self.levels[inventory_item_id] = quantity
+                self.changed[inventory_item_id] = quantity
+
+    def save(self):
+        with self.lock:
+            changed, self.changed = self.changed, {}
+        if changed:
+            try:
+                self.store.save_pushed_levels(changed)
+            except Exception:
+                # Kept for the next save, newer quantities win
+                with self.lock:
+                    self.changed = {**changed, **self.changed}
+                raise
+
+
+class _ProductTask():
+
+    def __init__(self, productId, productJson, pending: int):
+        self.productId = productId
+        self.productJson = productJson
+        self.pending = pending
+
+
+class ConcurrentSync():
+
+    def __init__(self, shopify_client, mypos_client, mypos_workers: int = SYNC_MYPOS_WORKERS,
+                 shopify_workers: int = SYNC_SHOPIFY_WORKERS, max_pending: int = SYNC_MAX_PENDING,
+                 batch_size: int = SYNC_BATCH_SIZE, pushed_cache: PushedLevelsCache = None):
+        self.shopify_client = shopify_client
+        self.mypos_client = mypos_client
+        self.mypos_workers = mypos_workers
+        self.shopify_workers = shopify_workers
+        self.batch_size = batch_size
+        self.pushed_cache = pushed_cache
+        # A partially filled batch holds its slots, so there must always be room to fill one
+        self.slots = threading.BoundedSemaphore(max(max_pending, batch_size))
+        self.batch = []
+        self.lock = threading.Lock()
+        # Maintained as variants finish, so progress never has to be recounted from the store
+        self.stats = {'processed': 0, 'total': None, 'variants': 0, 'synced': 0, 'errors': 0, 'warnings': 0, 'writes': 0, 'skipped': 0}
+        self.started = None
+        self.last_report = None
+        self.last_progress = None
+
+    def run(self, products, on_product_done=None, on_progress=None, total: int = None) -> dict:
+        # products yields (productId, productJson) where productJson is {productId: [variants]}
+        # total is the number of products expected, only used for progress reporting
+        self.on_product_done = on_product_done
+        self.on_progress = on_progress
+        self.stats['total'] = total
+        self.started = self.last_report = self.last_progress = time.monotonic()
+        self._publish()
+        self.mypos_pool = ThreadPoolExecutor(max_workers=self.mypos_workers, thread_name_prefix='sync-mypos')
+        self.shopify_pool = ThreadPoolExecutor(max_workers=self.shopify_workers, thread_name_prefix='sync-shopify')
+        try:
+            for productId, productJson in products:
+                self._submit_product(productId, productJson)
+        finally:
+            # MYPOS stage hands work to the Shopify stage, so it has to drain first
+            self.mypos_pool.shutdown(wait=True)
+            self._flush_batch(force=True)
+            self.shopify_pool.shutdown(wait=True)
+            if self.pushed_cache:
+                self.pushed_cache.save()
+        self._report(final=True)
+        return self.stats
+
+    def _submit_product(self, productId, productJson):
+        variants = productJson[productId]
+        withSku = [variant for variant in variants if variant['sku']]
+        task = _ProductTask(productId, productJson, len(withSku))
+        for variant in variants:
+            if not variant['sku']:
+                self._mark(variant, error=False, warning=True, message="SKU is not defined")
+                self._count('warnings')
+        if not withSku:
+            self._product_done(task)
+            return
+        for variant in withSku:
+            self.slots.acquire()
+            self.mypos_pool.submit(self._fetch_stock, task, variant)
+
+    def _fetch_stock(self, task: _ProductTask, variant: dict):
+        try:
+            quantity = self.mypos_client.get_stock(productCode=variant['sku'])
+        except Exception as ex:
+            logging.exception(ex)
+            quantity = None
+        if type(quantity) == int or type(quantity) == float:
+            # Same quantity as the last run wrote, nothing to read or push
+            if self.pushed_cache and self.pushed_cache.get(variant['inventory_item_id']) == int(quantity):
+                self._mark(variant, error=False, warning=False, message="Unchanged")
+                self._variant_done(task, 'synced', skipped=True)
+                return
+            with self.lock:
+                self.batch.append((task, variant, quantity))
+            self._flush_batch()
+        else:
+            self._mark(variant, error=True, warning=False, message="Product stock not found in MYPOS")
+            self._variant_done(task, 'errors')
+
+    def _flush_batch(self, force: bool = False):
+        with self.lock:
+            if not self.batch or (len(self.batch) < self.batch_size and not force):
+                return
+            batch, self.batch = self.batch[:self.batch_size], self.batch[self.batch_size:]
+            more = bool(self.batch)
+        self.shopify_pool.submit(self._push_batch, batch)
+        if more:
+            self._flush_batch(force=force)
+
+    def _push_batch(self, batch: list):
+        # Every variant has to reach _variant_done exactly once, a slot that is never released blocks the MYPOS stage
+        # for good. finished holds the ones that did, whatever escapes fails the rest.
+        finished = set()
+        try:
+            self._push_levels(batch, finished)
+        except Exception as ex:
+            logging.exception(ex)
+            for task, variant, _ in batch:
+                if id(variant) not in finished:
+                    self._mark(variant, error=True, warning=False, message="Inventory level update failed")
+                    self._finish(finished, task, variant, 'errors')
+
+    def _push_levels(self, batch: list, finished: set):
+        try:
+            levels = self.shopify_client.get_inventory_levels_batch([variant['inventory_item_id'] for _, variant, _ in batch])
+        except Exception as ex:
+            logging.exception(ex)
+            levels = None
+        writes = []
+        for task, variant, quantity in batch:
+            inventory_levels = None if levels is None else levels.get(variant['inventory_item_id'])
+            if levels is None:
+                self._mark(variant, error=True, warning=False, message="Inventory level lookup failed")
+                self._finish(finished, task, variant, 'errors')
+            elif not inventory_levels:
+                self._mark(variant, error=True, warning=False, message="Inventory level not found in Shopify")
+                self._finish(finished, task, variant, 'errors')
+            elif inventory_levels[0]['available'] == int(quantity):
+                self._stock_pushed(finished, task, variant, quantity, skipped=True)
+            else:
+                writes.append((task, variant, quantity, inventory_levels[0]))
+        if writes:
+            self._write_levels(writes, finished)
+
+    def _write_levels(self, writes: list, finished: set):
+        # Every change in the batch goes out in one inventory mutation, written only where Shopify still holds what was read
+        levels = [dict(inventory_level, available=int(quantity), previous=inventory_level['available'])
+                  for _, _, quantity, inventory_level in writes]
+        try:
+            failures = self.shopify_client.set_inventory_levels_batch(levels)
+        except Exception as ex:
+            logging.exception(ex)
+            failures = {inventory_level['inventory_item_id']: "Inventory level update failed" for inventory_level in levels}
+        for task, variant, quantity, inventory_level in writes:
+            message = failures.get(inventory_level['inventory_item_id'])
+            if message:
+                self._mark(variant, error=True, warning=False, message=message)
+                self._finish(finished, task, variant, 'errors')
+            else:
+                self._stock_pushed(finished, task, variant, quantity, skipped=False)
+
+    def _stock_pushed(self, finished: set, task: _ProductTask, variant: dict, quantity, skipped: bool):
+        if self.pushed_cache:
+            self.pushed_cache.set(variant['inventory_item_id'], int(quantity))
+        self._mark(variant, error=False, warning=False, message="Unchanged" if skipped else "Synced")
+        self._finish(finished, task, variant, 'synced', skipped=skipped)
+
+    def _finish(self, finished: set, task: _ProductTask, variant: dict, key: str, skipped: bool = False):
+        # Recorded first, so a failure after the slot was released can't release it twice
+        finished.add(id(variant))
+        self._variant_done(task, key, skipped=skipped)
+
+    @staticmethod
+    def _mark(variant: dict, error: bool, warning: bool, message: str):
+        variant['error'] = error
+        variant['warning'] = warning
+        variant['message'] = message
+
+    def _count(self, key: str):
+        with self.lock:
+            self.stats['variants'] += 1
+            self.stats[key] += 1
+        metrics.SYNC_VARIANTS.inc(result=key)
+
+    def _variant_done(self, task: _ProductTask, key: str, skipped: bool = False):
+        self.slots.release()
+        metrics.SYNC_VARIANTS.inc(result='skipped' if skipped else key)
+        with self.lock:
+            self.stats['variants'] += 1
+            self.stats[key] += 1
+            if key == 'synced':
+                self.stats['skipped' if skipped else 'writes'] += 1
+            task.pending -= 1
+            finished = task.pending == 0
+            now = time.monotonic()
+            report = now - self.last_report >= SYNC_REPORT_INTERVAL
+            publish = now - self.last_progress >= SYNC_PROGRESS_INTERVAL
+            if report:
+                self.last_report = now
+            if publish:
+                self.last_progress = now
+        if finished:
+            self._product_done(task)
+        if report:
+            if self.pushed_cache:
+                try:
+                    self.pushed_cache.save()
+                except Exception as ex:
+                    # e.g. the store is locked, the levels are saved again with the next report or at the end
+                    logging.exception(ex)
+            self._report()
+        elif publish:
+            self._publish()
+
+    def _product_done(self, task: _ProductTask):
+        with self.lock:
+            self.stats['processed'] += 1
+        if not self.on_product_done:
+            return
+        try:
+            self.on_product_done(task.productId, task.productJson)
+        except Exception as ex:
+            logging.exception(ex)
+
+    def _publish(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        with self.lock:
+            self.stats['elapsed'] = round(elapsed, 2)
+            self.stats['variants_per_sec'] = round(self.stats['variants'] / elapsed, 2)
+            stats = dict(self.stats)
+        if self.on_progress:
+            try:
+                self.on_progress(stats)
+            except Exception as ex:
+                logging.exception(ex)
+        return stats
+
+    def _report(self, final: bool = False):
+        stats = self._publish()
+        prefix = 'Sync finished:' if final else 'Sync progress:'
+        print(prefix, stats['processed'], 'products,', stats['variants'], 'variants in', stats['elapsed'], 'sec,',
+              stats['variants_per_sec'], 'variants/sec,', stats['writes'], 'writes,',
+              stats['skipped'], 'skipped,', stats['errors'], 'errors')
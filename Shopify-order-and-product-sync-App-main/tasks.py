@@ -0,0 +1,195 @@
+import os
+import time
+import logging
+import threading
+
+from requests.exceptions import RequestException, HTTPError
+
+import metrics
+from cache import TTLCache
+from jobs import JobQueue, JobRunner, JOB_WORKERS
+from orders import process_order
+from shopify_client import ShopifyStoreClient, MYPOSConnectClient, CURRENT_DIR
+from shops import ShopRegistry, SHOPS_FILE, normalize_shop
+from webhook_dedup import WebhookDeduplicator
+
+TOKEN_FILE2 = "mypos_token.txt"
+JOBS_DB = f"{CURRENT_DIR}/data/jobs.db"
+WEBHOOKS_DB = f"{CURRENT_DIR}/data/webhooks.db"
+# Webhook deliveries are drained from their own queue so a long sync never delays them
+WEBHOOK_QUEUE = 'webhooks'
+WEBHOOK_WORKERS = 4
+# The webhook route has already answered 200, so a delivery that failed on an upstream outage (MYPOS down during an
+# order) is retried with backoff, about 4 hours in all, and then kept as a dead letter: python worker.py --queue webhooks --redrive
+WEBHOOK_JOB_RETRIES = 10
+QUEUE_RETRIES = {WEBHOOK_QUEUE: WEBHOOK_JOB_RETRIES}
+
+# MYPOS product descriptions barely change, keep them for a day and drop them when a product webhook touches the SKU
+MYPOS_PRODUCT_CACHE_SIZE = 5000
+MYPOS_PRODUCT_CACHE_TTL = 24 * 60 * 60
+product_cache = TTLCache(MYPOS_PRODUCT_CACHE_SIZE, MYPOS_PRODUCT_CACHE_TTL, persist_path=f"{CURRENT_DIR}/data/mypos_product_cache.json")
+
+_runners = []
+_runner_lock = threading.Lock()
+
+
+def job_queue() -> JobQueue:
+    return JobQueue.open(JOBS_DB)
+
+
+def webhook_deliveries() -> WebhookDeduplicator:
+    return WebhookDeduplicator.open(WEBHOOKS_DB)
+
+
+def shops() -> ShopRegistry:
+    return ShopRegistry.open(SHOPS_FILE)
+
+
+def shop_client(shop: str) -> ShopifyStoreClient:
+    # Cached per shop, each with its own token, data directory and rate limit bucket
+    return shops().client(shop)
+
+
+def mypos_client() -> MYPOSConnectClient:
+    # Every MYPOS entry point shares one token, cached in memory and in mypos_token.txt
+    return MYPOSConnectClient.shared(f'{CURRENT_DIR}/{TOKEN_FILE2}', product_cache=product_cache)
+
+
+def load_products_job(job: dict, report_progress) -> dict:
+    payload = job['payload']
+    shopify_client = shop_client(payload['shop'])
+    # One count call per load, polling only ever reads it back from the job and the store meta
+    productsInTotal = shopify_client.get_products_count()
+    if productsInTotal is not None:
+        shopify_client.store.set_meta('products_count',productsInTotal)
+    report_progress({'loadedProducts': 0, 'productsInTotal': productsInTotal})
+    shopify_client.settings.update(loadActive=True)
+    on_progress = lambda loaded: report_progress({'loadedProducts': loaded, 'productsInTotal': productsInTotal})
+    mode = 'incremental' if payload.get('incremental', False) else 'bulk'
+    try:
+        if mode == 'incremental':
+            loaded = shopify_client.load_all_products(incremental=True, on_progress=on_progress)
+        else:
+            try:
+                loaded = shopify_client.load_all_products_bulk(on_progress=on_progress)
+            except (RequestException, TimeoutError) as ex:
+                # e.g. another bulk operation is already running for the app, fall back to REST pages
+                logging.warning(f"Bulk product export failed, loading through REST: {ex}")
+                mode = 'rest'
+                loaded = shopify_client.load_all_products(on_progress=on_progress)
+    finally:
+        shopify_client.settings.update(loadActive=False)
+    metrics.PRODUCTS_LOADED.inc(loaded, mode=mode)
+    loadedProducts = shopify_client.count_loaded_products()
+    shopify_client.store.set_meta('products_count',loadedProducts)
+    return {'loadedProducts': loadedProducts, 'productsInTotal': loadedProducts}
+
+
+def sync_products_job(job: dict, report_progress) -> dict:
+    payload = job['payload']
+    shopify_client = shop_client(payload['shop'])
+    progress = {}
+
+    def on_progress(stats):
+        progress.update(stats)
+        report_progress(stats)
+
+    shopify_client.sync_products(mypos_client(), concurrent=True, snapshot=True, diff_only=True, on_progress=on_progress)
+    return progress
+
+
+def sync_status(job: dict, store) -> dict:
+    # Built from the counters the sync engine keeps on the job record, no store scan and no Shopify call.
+    # job is None when the shop never ran a sync.
+    job = job or {'id': None, 'status': 'idle'}
+    progress = job.get('progress') or job.get('result') or {}
+    total = progress.get('total')
+    if total is None:
+        total = store.get_meta('products_count')
+    return {'jobId': job['id'], 'status': job['status'], 'progress': progress,
+            'syncedProducts': progress.get('processed', 0), 'productsInTotal': total,
+            'synced': progress.get('synced', 0), 'errors': progress.get('errors', 0), 'skipped': progress.get('skipped', 0)}
+
+
+def products_update_job(job: dict, report_progress):
+    payload = job['payload']
+    product = payload['body']
+    shopify_client = shop_client(payload['shop'])
+    # Old SKUs too, in case a variant was renamed
+    skus = shopify_client.store.variant_skus(product['id']) + [variant.get('sku') for variant in product.get('variants') or []]
+    product_cache.invalidate(*[sku for sku in skus if sku])
+    if not shopify_client.load_product(product):
+        logging.info(f"Skipped products/update for {product['id']} from {payload['shop']}, a newer version is already stored")
+
+
+def products_delete_job(job: dict, report_progress):
+    payload = job['payload']
+    product = payload['body']
+    shopify_client = shop_client(payload['shop'])
+    product_cache.invalidate(*shopify_client.store.variant_skus(product['id']))
+    shopify_client.delete_product(product)
+
+
+def order_fullfilled_job(job: dict, report_progress):
+    order = job['payload']['body']
+    logging.info(f"Processing order {order.get('order_number')} from {job['payload']['shop']}")
+    # The customer and receipt of an earlier attempt are kept on the job's progress, a retry reuses them
+    booking = job.get('progress') or {}
+    receiptId = process_order(order, mypos_client(), booking=booking, save_booking=report_progress)
+    if not receiptId:
+        return {'warning': f"No products of order {order.get('order_number')} are known to MYPOS, nothing booked"}
+    return {'receiptId': receiptId}
+
+
+def transient_error(ex: Exception) -> bool:
+    # No answer, a timeout or a 5xx/429 may go away by the next retry, bad data (KeyError, ValueError, a 4xx) won't
+    if isinstance(ex, HTTPError) and ex.response is not None:
+        return ex.response.status_code >= 500 or ex.response.status_code == 429
+    return isinstance(ex, (RequestException, TimeoutError))
+
+
+JOB_HANDLERS = {
+    'load_products': load_products_job,
+    'sync_products': sync_products_job,
+    'products_update': products_update_job,
+    'products_delete': products_delete_job,
+    'order_fullfilled': order_fullfilled_job,
+}
+
+
+def enqueue_webhook(topic: str, shop: str, body: dict) -> str:
+    # Persist first, process later: the webhook route only has to survive until this insert commits
+    return job_queue().enqueue(topic, {'shop': normalize_shop(shop), 'body': body}, queue=WEBHOOK_QUEUE)
+
+
+def enqueue_unique(kind: str, payload: dict) -> dict:
+    # Returns the running job for this shop if there is one, otherwise queues a new one
+    payload = dict(payload, shop=normalize_shop(payload['shop']))
+    return job_queue().enqueue_unique(kind, payload, ('shop',))
+
+
+def latest_job(kind: str, shop: str) -> dict:
+    # What the admin page polls: the shop's running job, or the one that finished last
+    return job_queue().latest(kind, {'shop': normalize_shop(shop)})
+
+
+def collect_job_metrics():
+    # Read from the job database, so every process reports the backlog no matter who runs the jobs
+    queue = job_queue()
+    metrics.JOBS.replace({(queue_name, kind, status): count for queue_name, kind, status, count in queue.counts()})
+    now = time.time()
+    metrics.JOBS_OLDEST_QUEUED.replace({(queue_name,): round(now - created_at, 1) for queue_name, created_at in queue.oldest_queued().items()})
+
+
+metrics.add_collector(collect_job_metrics)
+
+
+def start_job_workers(workers: int = JOB_WORKERS, webhook_workers: int = WEBHOOK_WORKERS) -> list:
+    # In-process workers for the web app. Skipped when JOB_WORKERS_EXTERNAL is set and worker.py runs the jobs instead.
+    with _runner_lock:
+        if not _runners and not os.environ.get('JOB_WORKERS_EXTERNAL'):
+            _runners.append(JobRunner(job_queue(), JOB_HANDLERS, workers=workers).start())
+            _runners.append(JobRunner(job_queue(), JOB_HANDLERS, queue_name=WEBHOOK_QUEUE, workers=webhook_workers,
+                                      retries=QUEUE_RETRIES[WEBHOOK_QUEUE], retry_if=transient_error).start())
+            logging.info(f"Started {workers} job workers and {webhook_workers} webhook workers in-process")
+        return _runners
@@ -0,0 +1,75 @@
+import os
+import sys
+import hmac
+import types
+import hashlib
+import tempfile
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+# config.py holds a deployment's secrets and is not part of the repo, the tests bring their own
+config = types.ModuleType('config')
+config.SHOPIFY_SECRET = 'test-secret'
+config.SHOPIFY_API_KEY = 'test-key'
+config.MYPOS_USER = 'test'
+config.MYPOS_PASS = 'test'
+config.MYPOS_SERVER = '127.0.0.1:9/'
+config.SERVER_HOST = 'test-host'
+config.INSTALL_REDIRECT_URL = 'https://test-host/app_installed'
+config.APP_NAME = 'test-app'
+config.WEBHOOK_APP_UNINSTALL_URL = 'https://test-host/app_uninstalled'
+config.WEBHOOK_APP_ORDER_DONE_URL = 'https://test-host/order_fullfilled'
+config.WEBHOOK_APP_PRODUCTS_UPDATE_URL = 'https://test-host/products_update'
+config.WEBHOOK_APP_PRODUCTS_DELETE_URL = 'https://test-host/products_delete'
+sys.modules['config'] = config
+
+# Every data path is built from the working directory at import time, so the tests get a throwaway one
+os.chdir(tempfile.mkdtemp(prefix='shopify-sync-tests-'))
+os.makedirs(f"{config.SERVER_HOST}/data", exist_ok=True)
+# Jobs are run by the tests themselves, the web app must not start workers of its own
+os.environ['JOB_WORKERS_EXTERNAL'] = '1'
+
+import mock_mypos
+import mock_shopify
+from rate_limiter import ShopifyRateLimiter
+
+
+@pytest.fixture
+def shopify():
+    shop = mock_shopify.MockShop(products=20, variants_per_product=2, bucket_size=1000, leak_rate=1000)
+    server = mock_shopify.run_server(shop)
+    yield shop
+    server.shutdown()
+
+
+@pytest.fixture
+def mypos():
+    mypos = mock_mypos.MockMYPOS(products=20, variants_per_product=2)
+    server = mock_mypos.run_server(mypos)
+    yield mypos
+    server.shutdown()
+
+
+@pytest.fixture
+def store_client(shopify, tmp_path):
+    from shopify_client import ShopifyStoreClient
+    shop = f"{tmp_path.name.lower().replace('_', '-')}.myshopify.com"
+    # The mock's bucket is large, the client's own limiter must not slow the tests down
+    ShopifyRateLimiter.for_shop(shop).leak_rate = 1000
+    (tmp_path / 'settings').mkdir()
+    return ShopifyStoreClient(shop=shop, access_token='test-token', api_url=shopify.api_url, data_dir=str(tmp_path))
+
+
+@pytest.fixture
+def mypos_client(mypos):
+    from shopify_client import MYPOSConnectClient
+    return MYPOSConnectClient(access_token=mypos.token, api_url=mypos.api_url)
+
+
+def signed_query(**args) -> dict:
+    # Query string as Shopify signs it for app pages, see helpers.verify_web_call
+    data = '&'.join(f"{key}={value}" for key, value in args.items())
+    return dict(args, hmac=hmac.new(config.SHOPIFY_SECRET.encode('utf-8'), data.encode('utf-8'), hashlib.sha256).hexdigest())
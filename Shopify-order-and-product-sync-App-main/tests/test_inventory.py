@@ -0,0 +1,67 @@
+from rate_limiter import ShopifyRateLimiter
+
+
+def read_levels(store_client, shopify, count: int) -> list:
+    ids = list(shopify.levels)[:count]
+    levels = store_client.get_inventory_levels_batch(ids)
+    return [levels[inventory_item_id][0] for inventory_item_id in ids]
+
+
+def changes(levels: list, available: int) -> list:
+    # What the sync hands over: the new quantity plus the one just read
+    return [dict(level, available=available, previous=level['available']) for level in levels]
+
+
+def test_levels_are_set_absolutely(store_client, shopify):
+    levels = read_levels(store_client, shopify, 3)
+
+    assert store_client.set_inventory_levels_batch(changes(levels, 7)) == {}
+    assert [shopify.levels[level['inventory_item_id']] for level in levels] == [7, 7, 7]
+
+
+def test_level_changed_since_the_read_is_left_alone(store_client, shopify):
+    levels = read_levels(store_client, shopify, 3)
+    moved = levels[1]['inventory_item_id']
+    # An order comes in between the read and the write
+    shopify.levels[moved] = -1
+
+    failures = store_client.set_inventory_levels_batch(changes(levels, 7))
+
+    assert list(failures) == [moved]
+    assert shopify.levels[moved] == -1
+    assert [shopify.levels[level['inventory_item_id']] for level in levels if level['inventory_item_id'] != moved] == [7, 7]
+
+
+def test_resent_write_is_not_applied_twice(store_client, shopify):
+    levels = read_levels(store_client, shopify, 2)
+    store_client.set_inventory_levels_batch(changes(levels, 7))
+    shopify.levels[levels[0]['inventory_item_id']] = 6
+
+    failures = store_client.set_inventory_levels_batch(changes(levels, 7))
+
+    assert set(failures) == {level['inventory_item_id'] for level in levels}
+    assert shopify.levels[levels[0]['inventory_item_id']] == 6
+
+
+def test_untracked_level_is_reported_not_raised(store_client, shopify):
+    untracked = list(shopify.levels)[0]
+    shopify.levels[untracked] = None
+    levels = read_levels(store_client, shopify, 3)
+    assert levels[0]['available'] is None
+
+    failures = store_client.set_inventory_levels_batch(changes(levels, 7))
+
+    assert failures == {untracked: "Inventory not tracked in Shopify"}
+    assert [shopify.levels[level['inventory_item_id']] for level in levels[1:]] == [7, 7]
+
+
+def test_throttled_graphql_call_is_retried_without_touching_the_rest_bucket(store_client, shopify):
+    levels = read_levels(store_client, shopify, 2)
+    shopify.graphql_throttled = 2
+    limiter = ShopifyRateLimiter.for_shop(store_client.shop)
+    blocked_until = limiter.blocked_until
+
+    assert store_client.set_inventory_levels_batch(changes(levels, 7)) == {}
+    assert shopify.calls['throttled'] == 2
+    assert limiter.blocked_until == blocked_until
+    assert [shopify.levels[level['inventory_item_id']] for level in levels] == [7, 7]
@@ -0,0 +1,51 @@
+import pytest
+
+import tasks
+
+
+def stored_variants(store_client) -> dict:
+    return {variant['sku']: variant for _, productJson in store_client.iter_loaded_products() for variants in productJson.values() for variant in variants}
+
+
+def test_bulk_load_stores_every_product_and_variant(store_client, shopify):
+    loaded = store_client.load_all_products_bulk()
+
+    assert loaded == len(shopify.products)
+    assert store_client.count_loaded_products() == len(shopify.products)
+    variants = stored_variants(store_client)
+    expected = {variant['sku']: variant for product in shopify.products for variant in product['variants']}
+    assert set(variants) == set(expected)
+    assert all(variants[sku]['inventory_item_id'] == expected[sku]['inventory_item_id'] for sku in expected)
+    assert shopify.calls['bulk download'] == 1
+    assert shopify.calls['products.json'] == 0
+
+
+def test_bulk_load_drops_products_gone_from_shopify(store_client, shopify):
+    store_client.load_all_products_bulk()
+    removed = shopify.products.pop()
+
+    store_client.load_all_products_bulk()
+
+    assert removed['id'] not in store_client.store.product_ids()
+    assert store_client.count_loaded_products() == len(shopify.products)
+
+
+@pytest.fixture
+def installed_shop(shopify, monkeypatch):
+    shop = 'loading.myshopify.com'
+    monkeypatch.setattr(tasks.shops(), 'api_url', shopify.api_url)
+    tasks.shops().set_token(shop, 'test-token')
+    return shop
+
+
+def test_load_job_falls_back_to_rest_when_bulk_is_refused(installed_shop, shopify):
+    shopify.bulk_busy = True
+    progress = []
+
+    result = tasks.load_products_job({'payload': {'shop': installed_shop}}, progress.append)
+
+    assert result == {'loadedProducts': len(shopify.products), 'productsInTotal': len(shopify.products)}
+    assert shopify.calls['bulk download'] == 0
+    assert shopify.calls['products.json'] > 0
+    assert progress[-1]['loadedProducts'] == len(shopify.products)
+    assert tasks.shop_client(installed_shop).settings.get()['loadActive'] is False
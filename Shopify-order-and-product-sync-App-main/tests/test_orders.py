@@ -0,0 +1,68 @@
+import pytest
+
+import tasks
+from jobs import JobQueue, JobRunner
+
+
+def make_order(number: int, skus: list) -> dict:
+    return {'order_number': number, 'created_at': '2021-01-01T10:00:00-05:00', 'tax_lines': [],
+            'customer': {'first_name': 'Test', 'last_name': 'Customer'},
+            'line_items': [{'sku': sku, 'price': '9.99', 'quantity': 1, 'taxable': True, 'tax_lines': []} for sku in skus]}
+
+
+@pytest.fixture
+def runner(mypos_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(tasks, 'mypos_client', lambda: mypos_client)
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    return JobRunner(queue, tasks.JOB_HANDLERS, queue_name=tasks.WEBHOOK_QUEUE, retries=3, retry_if=tasks.transient_error)
+
+
+def run_until_settled(runner: JobRunner, job_id: str) -> dict:
+    # Runs the job like a worker would, retries included but without waiting out the backoff
+    for _ in range(runner.retries + 1):
+        job = runner.queue.get(job_id)
+        if job['status'] != 'queued':
+            break
+        runner.run_job(job)
+    return runner.queue.get(job_id)
+
+
+def enqueue_order(runner: JobRunner, order: dict) -> str:
+    return runner.queue.enqueue('order_fullfilled', {'shop': 'orders.myshopify.com', 'body': order}, queue=tasks.WEBHOOK_QUEUE)
+
+
+def test_retried_order_reuses_customer_and_receipt(runner, mypos):
+    # MYPOS books the first two posts but the answers are lost
+    mypos.lost_sales = 2
+    job_id = enqueue_order(runner, make_order(1001, ['SKU-0-0', 'SKU-1-1']))
+
+    job = run_until_settled(runner, job_id)
+
+    assert job['status'] == 'done'
+    assert job['retries'] == 2
+    assert mypos.customers == 1
+    assert len(mypos.sales) == 3
+    receipts = {(item['receiptId'], item['receiptCode'], item['customerId']) for sale in mypos.sales for item in sale['items']}
+    assert len(receipts) == 1
+    assert job['result'] == {'receiptId': receipts.pop()[0]}
+
+
+def test_order_without_mypos_products_completes_with_warning(runner, mypos):
+    job_id = enqueue_order(runner, make_order(1002, ['NOT-IN-MYPOS']))
+
+    job = run_until_settled(runner, job_id)
+
+    assert job['status'] == 'done'
+    assert 'nothing booked' in job['result']['warning']
+    assert mypos.customers == 0
+    assert mypos.sales == []
+
+
+def test_malformed_order_is_not_retried(runner, mypos):
+    job_id = enqueue_order(runner, {'order_number': 1003})
+
+    job = run_until_settled(runner, job_id)
+
+    assert job['status'] == 'dead'
+    assert job['retries'] == 0
+    assert 'KeyError' in job['error']
@@ -0,0 +1,24 @@
+import progress
+from jobs import JobQueue
+
+
+def test_stream_closes_and_lets_the_browser_reconnect(tmp_path, monkeypatch):
+    monkeypatch.setattr(progress, 'PROGRESS_STREAM_MAX_AGE', 0)
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    job_id = queue.enqueue('sync_products', {'shop': 'progress.myshopify.com'})
+
+    events = list(progress.progress_events(queue, job_id, interval=0))
+
+    assert events[0] == f"retry: {progress.PROGRESS_RETRY_MS}\n\n"
+    assert events[1].startswith('event: progress\n')
+    assert len(events) == 2
+
+
+def test_stream_ends_with_the_job(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    job_id = queue.enqueue('load_products', {'shop': 'progress.myshopify.com'})
+    queue.complete(job_id, {'loadedProducts': 3, 'productsInTotal': 3})
+
+    events = list(progress.progress_events(queue, job_id, interval=0))
+
+    assert events[-1].startswith('event: done\n')
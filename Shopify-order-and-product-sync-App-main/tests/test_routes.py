@@ -0,0 +1,113 @@
+import hmac
+import json
+import base64
+import hashlib
+import functools
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+import tasks
+import flask_app
+from shopify_client import ShopifyStoreClient
+from conftest import signed_query
+
+
+@pytest.fixture
+def app_client(shopify, monkeypatch):
+    # Token exchange and webhook registration go to mock_shopify
+    monkeypatch.setattr(ShopifyStoreClient, 'authenticate', staticmethod(functools.partial(ShopifyStoreClient.authenticate, oauth_url=shopify.oauth_url)))
+    monkeypatch.setattr(tasks.shops(), 'api_url', shopify.api_url)
+    return flask_app.app.test_client()
+
+
+def install_nonce(app_client, shop: str) -> str:
+    response = app_client.get('/app_launched', query_string=signed_query(shop=shop))
+    assert response.status_code == 302
+    return parse_qs(urlsplit(response.headers['Location']).query)['state'][0]
+
+
+def test_app_installed_stores_token_and_registers_webhooks(app_client, shopify):
+    shop = 'install-test.myshopify.com'
+    state = install_nonce(app_client, shop)
+
+    response = app_client.get('/app_installed', query_string=signed_query(code='oauth-code', shop=shop, state=state))
+
+    assert response.status_code == 302
+    assert response.headers['Location'] == f"https://{shop}/admin/apps/test-app"
+    assert tasks.shops().token(shop) == shopify.access_token
+    assert sorted(webhook['topic'] for webhook in shopify.webhooks) == sorted(
+        ['app/uninstalled', 'orders/fulfilled', 'products/create', 'products/update', 'products/delete'])
+
+
+def test_app_installed_rejects_reused_state(app_client, shopify):
+    shop = 'install-replay.myshopify.com'
+    state = install_nonce(app_client, shop)
+    assert app_client.get('/app_installed', query_string=signed_query(code='oauth-code', shop=shop, state=state)).status_code == 302
+
+    response = app_client.get('/app_installed', query_string=signed_query(code='oauth-code', shop=shop, state=state))
+
+    assert response.status_code == 400
+    assert shopify.calls['oauth/access_token'] == 1
+
+
+def test_app_installed_rejects_bad_hmac(app_client):
+    query = signed_query(code='oauth-code', shop='install-hmac.myshopify.com', state='x')
+    query['code'] = 'tampered'
+
+    assert app_client.get('/app_installed', query_string=query).status_code == 400
+
+
+@pytest.mark.parametrize('route, kind', [('/app_loadProducts', 'load_products'), ('/app_syncProducts', 'sync_products')])
+def test_polling_never_queues_a_job(app_client, route, kind):
+    shop = f"poll-{kind.replace('_', '-')}.myshopify.com"
+    tasks.shops().set_token(shop, 'test-token')
+    query = signed_query(shop=shop)
+    poll = lambda **form: app_client.post(route, query_string=query, data=dict(form, shop=shop)).get_json(force=True)
+
+    assert poll()['status'] == 'idle'
+    started = poll(start='true')
+    assert started['status'] == 'queued'
+    assert poll()['jobId'] == started['jobId']
+
+    tasks.job_queue().complete(started['jobId'], {})
+    finished = poll()
+
+    assert finished['jobId'] == started['jobId']
+    assert finished['status'] == 'done'
+    assert tasks.job_queue().active(kind, {'shop': shop}) is None
+
+
+def post_webhook(app_client, route: str, topic: str, shop: str, body: dict, webhook_id: str):
+    data = json.dumps(body).encode('utf-8')
+    signature = base64.b64encode(hmac.new(b'test-secret', data, hashlib.sha256).digest()).decode('ascii')
+    return app_client.post(route, data=data, content_type='application/json',
+                           headers={'X-Shopify-Hmac-Sha256': signature, 'X-Shopify-Topic': topic,
+                                    'X-Shopify-Shop-Domain': shop, 'X-Shopify-Webhook-Id': webhook_id})
+
+
+def queued_jobs(kind: str) -> int:
+    return sum(count for queue, job_kind, status, count in tasks.job_queue().counts() if job_kind == kind and queue == tasks.WEBHOOK_QUEUE)
+
+
+def test_webhook_is_queued_once_per_delivery(app_client):
+    shop = 'Webhooks.myshopify.com'
+    before = queued_jobs('products_update')
+
+    first = post_webhook(app_client, '/products_update', 'products/update', shop, {'id': 42, 'title': 'A'}, 'delivery-1')
+    redelivered = post_webhook(app_client, '/products_update', 'products/update', shop, {'id': 42, 'title': 'A'}, 'delivery-1')
+    next_update = post_webhook(app_client, '/products_update', 'products/update', shop, {'id': 42, 'title': 'B'}, 'delivery-2')
+
+    assert [first.status_code, redelivered.status_code, next_update.status_code] == [200, 200, 200]
+    assert queued_jobs('products_update') == before + 2
+    job = tasks.job_queue().latest('products_update', {'shop': 'webhooks.myshopify.com'})
+    assert job['payload']['body'] == {'id': 42, 'title': 'B'}
+
+
+def test_webhook_with_bad_signature_is_rejected(app_client):
+    before = queued_jobs('order_fullfilled')
+    response = app_client.post('/order_fullfilled', data=b'{"id": 1}', content_type='application/json',
+                               headers={'X-Shopify-Hmac-Sha256': base64.b64encode(b'forged').decode('ascii'), 'X-Shopify-Webhook-Id': 'delivery-x'})
+
+    assert response.status_code == 401
+    assert queued_jobs('order_fullfilled') == before
@@ -0,0 +1,34 @@
+import pytest
+
+import shops
+from shops import ShopRegistry, DATA_DIR
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    token_file = tmp_path / 'shopify_token.txt'
+    token_file.write_text('legacy-token\n')
+    monkeypatch.setattr(shops, 'LEGACY_TOKEN_FILE', str(token_file))
+    monkeypatch.setattr(shops, 'LEGACY_SHOP', None)
+    return ShopRegistry(str(tmp_path / 'shops.json'))
+
+
+def test_lookups_never_adopt_the_legacy_install(registry):
+    assert registry.get('webhook-first.myshopify.com') is None
+    assert registry.shops() == []
+
+
+def test_first_verified_launch_adopts_the_legacy_install(registry):
+    entry = registry.adopt_legacy('Launched.myshopify.com')
+
+    assert entry['access_token'] == 'legacy-token'
+    assert entry['data_dir'] == DATA_DIR
+    assert registry.adopt_legacy('second.myshopify.com') is None
+    assert registry.shops() == ['launched.myshopify.com']
+
+
+def test_configured_legacy_shop_is_the_only_one_adopting(registry, monkeypatch):
+    monkeypatch.setattr(shops, 'LEGACY_SHOP', 'teststore.myshopify.com/')
+
+    assert registry.adopt_legacy('other.myshopify.com') is None
+    assert registry.get('teststore.myshopify.com')['access_token'] == 'legacy-token'
@@ -0,0 +1,81 @@
+import time
+import sqlite3
+import threading
+
+from cache import TTLCache
+
+# Shopify retries a failed delivery for up to 48 hours, remember ids a bit longer than that
+WEBHOOK_DEDUP_TTL = 72 * 60 * 60
+# Recent deliveries answered from memory without touching the database
+WEBHOOK_DEDUP_CACHE_SIZE = 10000
+# Expired rows are purged once every this many claims
+WEBHOOK_DEDUP_PURGE_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_deliveries (
+    key TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS webhook_deliveries_received_at ON webhook_deliveries (received_at);
+"""
+
+
+class WebhookDeduplicator():
+    # Remembers webhook deliveries so a redelivery is acknowledged without being processed again
+
+    _deduplicators = {}
+    _deduplicators_lock = threading.Lock()
+
+    def __init__(self, path: str, ttl: float = WEBHOOK_DEDUP_TTL, cache_size: int = WEBHOOK_DEDUP_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.recent = TTLCache(cache_size, ttl)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.claims = 0
+        self.connection().executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, path: str) -> 'WebhookDeduplicator':
+        with cls._deduplicators_lock:
+            if path not in cls._deduplicators:
+                cls._deduplicators[path] = cls(path)
+            return cls._deduplicators[path]
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def claim(self, key: str) -> bool:
+        # True for the first delivery of key, False for a duplicate. The insert is atomic, so only one
+        # of two web workers receiving the same delivery at once gets True.
+        if self.recent.get(key):
+            return False
+        now = time.time()
+        # An expired row is taken over as if it wasn't there
+        cursor = self.connection().execute('INSERT INTO webhook_deliveries (key, received_at) VALUES (?, ?) '
+                                           'ON CONFLICT (key) DO UPDATE SET received_at = excluded.received_at WHERE received_at < ?',
+                                           (key, now, now - self.ttl))
+        self.recent.set(key, True)
+        with self.lock:
+            self.claims += 1
+            purge = self.claims % WEBHOOK_DEDUP_PURGE_EVERY == 0
+        if purge:
+            self.purge()
+        return cursor.rowcount == 1
+
+    def release(self, key: str):
+        # Handling failed, let Shopify's retry through
+        self.recent.invalidate(key)
+        self.connection().execute('DELETE FROM webhook_deliveries WHERE key = ?', (key,))
+
+    def purge(self) -> int:
+        return self.connection().execute('DELETE FROM webhook_deliveries WHERE received_at < ?', (time.time() - self.ttl,)).rowcount
+
+
+def delivery_key(webhook_id: str, topic: str, resource_id) -> str:
+    return f"{topic}:{resource_id}:{webhook_id}"
@@ -0,0 +1,37 @@
+import signal
+import logging
+import argparse
+import threading
+
+import tasks
+import metrics
+from jobs import JobRunner, JOB_WORKERS
+
+# Standalone job worker. Run one or more of these per queue next to the web app (started with
+# JOB_WORKERS_EXTERNAL=1) so loads, syncs and webhooks never share a process with Flask workers.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run background load/sync jobs')
+    parser.add_argument('--workers', type=int, default=JOB_WORKERS)
+    parser.add_argument('--queue', default='default', help=f"'default' for loads/syncs, '{tasks.WEBHOOK_QUEUE}' for webhook deliveries")
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics of this worker on this port')
+    parser.add_argument('--redrive', action='store_true', help='queue the dead letters of --queue again and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.redrive:
+        print(f"{tasks.job_queue().redrive(args.queue)} dead jobs queued again on {args.queue}")
+        raise SystemExit(0)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+
+    if args.metrics_port:
+        metrics.serve_metrics(args.metrics_port)
+        logging.info(f"Serving metrics on port {args.metrics_port}")
+    runner = JobRunner(tasks.job_queue(), tasks.JOB_HANDLERS, queue_name=args.queue, workers=args.workers,
+                       retries=tasks.QUEUE_RETRIES.get(args.queue, 0), retry_if=tasks.transient_error).start()
+    logging.info(f"Worker {runner.worker_id} running {args.workers} job threads on queue {args.queue}")
+    stopped.wait()
+    # Jobs still running are picked up again by the next worker once their heartbeat goes stale
+    runner.stop(timeout=5)